@@ -396,13 +396,12 @@ async def search_ids(interaction: discord.Interaction, keyword: str):
     await interaction.response.defer(thinking=True, ephemeral=True)
     guild_id = str(interaction.guild_id)
 
-    docs = await firestore_stream(db.collection("ids").document(guild_id).collection("players"))
+    roster = await fetch_roster(guild_id)
 
     keyword_lower = keyword.lower()
     players = []
-    for doc in docs:
-        data = doc.to_dict()
-        pid = doc.id
+    for data in roster:
+        pid = data.get("id", "")
         name = data.get("name", "")
         kingdom = data.get("kingdom", "")
         if keyword_lower in pid.lower() or keyword_lower in name.lower() or keyword_lower in str(kingdom).lower():
@@ -435,7 +434,7 @@ async def search_ids(interaction: discord.Interaction, keyword: str):
 
 # === Redeem 兌換 ===
 @tree.command(name="redeem_submit", description="提交兌換碼 / Submit redeem code")
-@app_commands.describe(code="要兌換的禮包碼", player_id="選填：指定兌換的玩家 ID（單人兌換）")
+@app_commands.describe(code="要兌換的禮包碼（多組以逗號或空白分隔）", player_id="選填：指定兌換的玩家 ID（單人兌換）")
 @interaction_guard
 async def redeem_submit(interaction: discord.Interaction, code: str, player_id: str = None):
     try:
@@ -455,13 +454,32 @@ async def redeem_submit(interaction: discord.Interaction, code: str, player_id:
     else:
         asyncio.create_task(trigger_backend_redeem(interaction, code))
 
-async def get_player_ids(guild_id):
+async def fetch_roster(guild_id):
+    """名冊優先向 redeem_web 的 /list_ids 取（後端有記憶體快取），失敗才直接讀 Firestore"""
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{REDEEM_API_URL}/list_ids", params={"guild_id": guild_id}, timeout=ClientTimeout(total=15)) as resp:
+                result = await resp.json()
+        if result.get("success"):
+            return result.get("players", [])
+        logger.warning(f"[fetch_roster] /list_ids 回傳失敗：{result.get('reason')}")
+    except (asyncio.TimeoutError, ClientError, ValueError) as e:
+        logger.warning(f"[fetch_roster] /list_ids 呼叫失敗，改讀 Firestore：{e}")
     docs = await firestore_stream(db.collection("ids").document(guild_id).collection("players"))
-    return [doc.id for doc in docs]
+    return [{"id": doc.id, **(doc.to_dict() or {})} for doc in docs]
+
+async def get_player_ids(guild_id):
+    return [p["id"] for p in await fetch_roster(guild_id) if p.get("id")]
 
 async def trigger_backend_redeem(interaction: discord.Interaction, code: str, player_ids: list = None):
     guild_id = str(interaction.guild_id)
 
+    # 多組兌換碼一次送出，後端每位玩家只登入一次
+    codes = [c for c in re.split(r"[,\s]+", code or "") if c]
+    if not codes:
+        await interaction.followup.send("⚠️ 請輸入兌換碼 / Please enter a redeem code", ephemeral=True)
+        return
+
     if player_ids is None:
         player_ids = await get_player_ids(guild_id)
 
@@ -471,7 +489,7 @@ async def trigger_backend_redeem(interaction: discord.Interaction, code: str, pl
 
     try:
         payload = {
-            "code": code,
+            "code": codes if len(codes) > 1 else codes[0],
             "player_ids": player_ids,
             "guild_id": str(interaction.guild_id),
             "debug": False
@@ -484,7 +502,13 @@ async def trigger_backend_redeem(interaction: discord.Interaction, code: str, pl
                 async with session.post(redeem_submit_url, json=payload, timeout=30) as resp:
                     logger.info(f"[trigger_backend_redeem] 後端回應狀態：{resp.status}")
                     if resp.status == 200:
-                        logger.info(f"[{guild_id}] ✅ 成功觸發後端兌換流程（未等待完成）")
+                        result = await resp.json(content_type=None)
+                        if result.get("code_status"):
+                            # 後端已知兌換碼失效，沒有排入任務
+                            logger.info(f"[{guild_id}] ⚠️ 兌換碼已知失效：{result.get('reason')}")
+                            await interaction.followup.send(f"⚠️ {result.get('reason')}", ephemeral=True)
+                            return
+                        logger.info(f"[{guild_id}] ✅ 成功觸發後端兌換流程（未等待完成）job_id={result.get('job_id')}")
                     else:
                         logger.error(f"[{guild_id}] ❌ API 回傳錯誤狀態：{resp.status}")
             except (asyncio.TimeoutError, ClientError) as e:
@@ -501,13 +525,17 @@ async def retry_failed(interaction: discord.Interaction, code: str):
     
     guild_id = str(interaction.guild_id)
 
-    # 從 Firestore 找到失敗的 ID
-    failed_docs = await firestore_stream(
-        db.collection("failed_redeems")
-        .document(f"{guild_id}_{code}")
-        .collection("players")
-    )
-    player_ids = [doc.id for doc in failed_docs]
+    # 從狀態摘要文件讀失敗的 ID（單次讀取）；舊資料沒有摘要時才逐筆讀子集合
+    status_doc = await firestore_get(db.collection("redeem_status").document(f"{guild_id}_{code}"))
+    if status_doc.exists:
+        player_ids = sorted((status_doc.to_dict() or {}).get("failed_ids", []))
+    else:
+        failed_docs = await firestore_stream(
+            db.collection("failed_redeems")
+            .document(f"{guild_id}_{code}")
+            .collection("players")
+        )
+        player_ids = [doc.id for doc in failed_docs]
 
     if not player_ids:
         await safe_send(interaction, "⚠️ 沒有找到失敗的 ID / No failed IDs found")
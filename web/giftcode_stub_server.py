@@ -0,0 +1,156 @@
+# giftcode_stub_server.py
+# 本機離線測試用：模擬禮包碼 API（/api/player、/api/captcha、/api/gift_code）與 2Captcha（/in.php、/res.php）
+#
+# 啟動：
+#   python web/giftcode_stub_server.py --port 8090
+# 讓 redeem_web 改打 stub：
+#   WOS_API_BASE=http://127.0.0.1:8090/api CAPTCHA_API_BASE=http://127.0.0.1:8090 CAPTCHA_API_KEY=stub REDEEM_ENGINE=http
+#
+# 行為：
+#   - 任何純數字 fid 都能登入；非數字回 ROLE NOT EXIST
+#   - --valid-codes 內的兌換碼可兌換，同一 fid 第二次回 RECEIVED
+#   - --expired-codes 回 TIME ERROR，--used-codes 回 USED（已兌換完畢），其他兌換碼回 CDK NOT FOUND
+#   - 2Captcha 端會回答 stub 自己發出的驗證碼；--wrong-rate 可模擬辨識錯誤，--throttle-rate 可模擬伺服器忙碌
+#   - /res.php 支援單筆 id= 與批次 ids=；--solve-delay 秒內回 CAPCHA_NOT_READY
+import argparse
+import base64
+import hashlib
+import itertools
+import os
+import random
+import string
+import time
+
+from aiohttp import web
+
+SECRET = os.getenv("WOS_API_SECRET", "tB87#kPtkxqOS2")
+
+
+def make_app(valid_codes, expired_codes, wrong_rate=0.0, throttle_rate=0.0, solve_delay=0.0, used_codes=()):
+    state = {
+        "captchas": {},   # fid -> 目前有效的驗證碼
+        "answers": {},    # 圖片 base64 -> 驗證碼文字
+        "tasks": {},      # 2Captcha 任務 ID -> (答案, 可取得時間)
+        "redeemed": set(),
+        "task_ids": itertools.count(1000),
+    }
+
+    def reply(code, msg, err_code="", data=None):
+        return web.json_response({"code": code, "data": data or {}, "msg": msg, "err_code": err_code})
+
+    async def read_params(request):
+        params = dict(await request.post())
+        sign = params.pop("sign", "")
+        raw = "&".join(f"{k}={params[k]}" for k in sorted(params))
+        if hashlib.md5((raw + SECRET).encode("utf-8")).hexdigest() != sign:
+            raise web.HTTPForbidden(text="Sign Error")
+        return params
+
+    async def player(request):
+        params = await read_params(request)
+        fid = params.get("fid", "")
+        if not fid.isdigit():
+            return reply(1, "role not exist.", 40004)
+        return reply(0, "success", data={
+            "fid": int(fid),
+            "nickname": f"stub_{fid}",
+            "kid": int(fid) % 900 + 1,
+            "stove_lv": 30,
+        })
+
+    async def captcha(request):
+        params = await read_params(request)
+        if random.random() < throttle_rate:
+            return reply(1, "CAPTCHA GET TOO FREQUENT.", 40100)
+        text = "".join(random.choices(string.ascii_letters + string.digits, k=4))
+        # 內容只要能被 /in.php 對回答案即可；補到 >1KB 以符合前端對圖片大小的檢查
+        img = base64.b64encode(f"STUBCAPTCHA:{text}:".encode() + os.urandom(1024)).decode()
+        state["captchas"][params.get("fid")] = text
+        state["answers"][img] = text
+        return reply(0, "SUCCESS", 20000, data={"img": f"data:image/png;base64,{img}"})
+
+    async def gift_code(request):
+        params = await read_params(request)
+        fid, cdk = params.get("fid"), params.get("cdk")
+        if random.random() < throttle_rate:
+            return reply(1, "TIMEOUT RETRY.", 40004)
+        expected = state["captchas"].pop(fid, None)
+        if expected is None:
+            return reply(1, "CAPTCHA EXPIRED.", 40102)
+        if params.get("captcha_code", "").lower() != expected.lower():
+            return reply(1, "CAPTCHA CHECK ERROR.", 40103)
+        if cdk in expired_codes:
+            return reply(1, "TIME ERROR.", 40007)
+        if cdk in used_codes:
+            return reply(1, "USED.", 40005)
+        if cdk not in valid_codes:
+            return reply(1, "CDK NOT FOUND.", 40014)
+        if (fid, cdk) in state["redeemed"]:
+            return reply(1, "RECEIVED.", 40008)
+        state["redeemed"].add((fid, cdk))
+        return reply(0, "SUCCESS", 20000)
+
+    async def captcha_in(request):
+        form = await request.post()
+        answer = state["answers"].pop(form.get("body", ""), None)
+        if answer is None:
+            return web.json_response({"status": 0, "request": "ERROR_WRONG_FILE_EXTENSION"})
+        if random.random() < wrong_rate:
+            answer = answer[::-1]
+        task_id = str(next(state["task_ids"]))
+        state["tasks"][task_id] = (answer, time.monotonic() + solve_delay)
+        return web.json_response({"status": 1, "request": task_id})
+
+    def task_answer(task_id):
+        task = state["tasks"].get(task_id)
+        if task is None:
+            return "ERROR_WRONG_CAPTCHA_ID"
+        answer, ready_at = task
+        if time.monotonic() < ready_at:
+            return "CAPCHA_NOT_READY"
+        del state["tasks"][task_id]
+        return answer
+
+    async def captcha_res(request):
+        if "ids" in request.query:
+            # 批次查詢：依 ids 順序以 | 串接
+            answers = [task_answer(i) for i in request.query["ids"].split(",") if i]
+            return web.json_response({"status": 1, "request": "|".join(answers)})
+        answer = task_answer(request.query.get("id", ""))
+        if answer.startswith("ERROR") or answer == "CAPCHA_NOT_READY":
+            return web.json_response({"status": 0, "request": answer})
+        return web.json_response({"status": 1, "request": answer})
+
+    app = web.Application()
+    app.router.add_post("/api/player", player)
+    app.router.add_post("/api/captcha", captcha)
+    app.router.add_post("/api/gift_code", gift_code)
+    app.router.add_post("/in.php", captcha_in)
+    app.router.add_get("/res.php", captcha_res)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="禮包碼 API / 2Captcha 本機 stub")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--valid-codes", default="WOSSTUB")
+    parser.add_argument("--expired-codes", default="WOSOLD")
+    parser.add_argument("--used-codes", default="WOSUSED")
+    parser.add_argument("--wrong-rate", type=float, default=0.0, help="2Captcha 故意答錯的比例")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="回覆忙碌 / 過於頻繁的比例")
+    parser.add_argument("--solve-delay", type=float, default=0.0, help="2Captcha 任務多久後才有答案（秒）")
+    args = parser.parse_args()
+
+    print(f"[Stub] 啟動於 http://127.0.0.1:{args.port}（valid={args.valid_codes} expired={args.expired_codes}）")
+    web.run_app(
+        make_app(
+            set(filter(None, args.valid_codes.split(","))),
+            set(filter(None, args.expired_codes.split(","))),
+            wrong_rate=args.wrong_rate,
+            throttle_rate=args.throttle_rate,
+            solve_delay=args.solve_delay,
+            used_codes=set(filter(None, args.used_codes.split(","))),
+        ),
+        port=args.port,
+        print=None,
+    )
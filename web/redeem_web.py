@@ -10,21 +10,36 @@ import hashlib
 import requests
 import time
 import contextlib
+import atexit
+import collections
 import sys
 import logging
 import aiohttp
 import threading
+import multiprocessing
+import queue
 import textwrap
+import weakref
+import socket
+import sqlite3
+import uuid
+import urllib.parse
+import random
 from textwrap import indent
-#Remove preprocess_image_for_2captcha()
 from io import BytesIO
 from flask import Flask, request, jsonify
 from playwright.async_api import async_playwright, TimeoutError
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
-#Remove preprocess_image_for_2captcha()
-#from PIL import Image
+try:
+    from PIL import Image, ImageChops, ImageOps  # 選用：驗證碼上傳前處理
+except ImportError:
+    Image = None
+try:
+    import ddddocr  # 選用：本機 CPU 驗證碼辨識，未安裝時只用 2Captcha
+except ImportError:
+    ddddocr = None
 import subprocess
 import nest_asyncio
 import functools
@@ -33,9 +48,6 @@ from datetime import datetime, timedelta, timezone
 tz = pytz.timezone("Asia/Taipei")
 from googletrans import Translator
 translator = Translator()
-from concurrent.futures import ThreadPoolExecutor
-REDEEM_THREAD_POOL = ThreadPoolExecutor(max_workers=1)
-DEFAULT_FETCH_LIMIT = 1
 # 說明：改為在事件迴圈內建立 asyncio.Semaphore，不再用全域 BoundedSemaphore
 from hashlib import sha256
 from hmac import compare_digest, new as hmac_new
@@ -56,14 +68,15 @@ logger.info("Flask app initialized")
 nest_asyncio.apply()
 loop = asyncio.get_event_loop_policy().get_event_loop()
 logger.info(f"[Startup] redeem_web 啟動中... PORT={os.environ.get('PORT', 8080)} LINE_CHANNEL_SECRET={'存在' if os.getenv('LINE_CHANNEL_SECRET') else '無'} CAPTCHA_API_KEY={'存在' if os.getenv('CAPTCHA_API_KEY') else '無'}")
-def build_summary_block(code, success, fail, skipped, duration, is_retry=False):
+def build_summary_block(code, success, fail, skipped, duration, is_retry=False, ledger_skipped=0):
     return (
         f"=== {'Retry ' if is_retry else ''}Summary ===\n"
         f"Giftcode : {code}\n"
         f"Success  : {success}\n"
         f"Failed   : {fail}\n"
         f"Skipped  : {skipped}\n"
-        f"Duration : {duration:.1f}s"
+        + (f"Ledger   : {ledger_skipped}（其他公會已兌換 / redeemed via another guild）\n" if ledger_skipped else "")
+        + f"Duration : {duration:.1f}s"
     )
 
 @contextlib.contextmanager
@@ -78,7 +91,14 @@ def suppress_stdout():
 
 def log_and_run(coro):
     logger.info("[Thread] 開始執行 asyncio.run 任務")
-    asyncio.run(coro)
+
+    async def runner():
+        try:
+            await coro
+        finally:
+            await close_http_connector()
+
+    asyncio.run(runner())
 
 def get_webhook_url_by_guild(guild_id: str) -> str:
     key = f"WEBHOOK_{guild_id}"
@@ -143,301 +163,1260 @@ async def firestore_delete(ref):
 async def firestore_stream(ref):
     return await run_in_executor(lambda: list(ref.stream()))
 
+# === Firestore 批次寫入 ===
+FIRESTORE_BATCH_SIZE = max(1, min(500, int(os.getenv("FIRESTORE_BATCH_SIZE", "400"))))  # 單次 commit 上限 500 筆
+FIRESTORE_FLUSH_INTERVAL = float(os.getenv("FIRESTORE_FLUSH_INTERVAL", "2"))  # 秒
+
+class FirestoreBatchWriter:
+    """累積 set / delete，滿 batch_size 或超過 flush_interval 才以 WriteBatch 提交。
+    整批 commit 失敗時改逐筆重送，讓個別錯誤仍能對應到各自的 label（通常是 player_id）。"""
+
+    def __init__(self, batch_size=FIRESTORE_BATCH_SIZE, flush_interval=FIRESTORE_FLUSH_INTERVAL, on_flush=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush  # flush 前呼叫 on_flush(writer)，可在同批補上彙總寫入
+        self._ops = []  # (label, kind, ref, data, merge)
+        self._last_flush = time.monotonic()
+        self.commits = 0
+        self.errors = []  # (label, error)
+
+    def set(self, ref, data, merge=False, label=None):
+        self._ops.append((label, "set", ref, data, merge))
+
+    def delete(self, ref, label=None):
+        self._ops.append((label, "delete", ref, None, False))
+
+    def __len__(self):
+        return len(self._ops)
+
+    async def maybe_flush(self):
+        if len(self._ops) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        if self.on_flush:
+            self.on_flush(self)
+        ops, self._ops = self._ops, []
+        self._last_flush = time.monotonic()
+        for i in range(0, len(ops), self.batch_size):
+            chunk = ops[i:i + self.batch_size]
+            try:
+                await run_in_executor(functools.partial(self._commit, chunk))
+                self.commits += 1
+            except Exception as e:
+                logger.warning(f"[Firestore] 批次寫入失敗（{len(chunk)} 筆），改逐筆重送：{e}")
+                for op in chunk:
+                    try:
+                        await run_in_executor(functools.partial(self._apply_one, op))
+                    except Exception as item_error:
+                        self.errors.append((op[0], str(item_error)))
+                        logger.warning(f"[Firestore] 寫入失敗：{op[0]} {op[1]} {op[2].path} error={item_error}")
+
+    @staticmethod
+    def _commit(chunk):
+        batch = db.batch()
+        for _, kind, ref, data, merge in chunk:
+            if kind == "set":
+                batch.set(ref, data, merge=merge)
+            else:
+                batch.delete(ref)
+        batch.commit()
+
+    @staticmethod
+    def _apply_one(op):
+        _, kind, ref, data, merge = op
+        if kind == "set":
+            ref.set(data, merge=merge)
+        else:
+            ref.delete()
+
+# === 兌換狀態摘要文件 ===
+CAPTCHA_FAILED_MARKERS = ("驗證碼三次辨識皆失敗", "CAPTCHA failed 3 times")
+
+def is_captcha_failure(reason):
+    return any(m in (reason or "") for m in CAPTCHA_FAILED_MARKERS)
+
+class RedeemStatus:
+    """redeem_status/{guild}_{code}：以單一文件保存 success / failed / captcha_failed 的 ID 陣列，
+    任務開始只讀這一份；與各玩家紀錄同批寫入維護。"""
+
+    def __init__(self, guild_id, code):
+        self.ref = db.collection("redeem_status").document(f"{guild_id}_{code}")
+        self.guild_id = guild_id
+        self.code = code
+        self.success_ids = set()
+        self.failed_ids = set()
+        self.captcha_failed_ids = set()
+        self._added = {"success_ids": set(), "failed_ids": set(), "captcha_failed_ids": set()}
+        self._removed = {"failed_ids": set(), "captcha_failed_ids": set()}
+
+    @classmethod
+    async def load(cls, guild_id, code):
+        status = cls(guild_id, code)
+        doc = await firestore_get(status.ref)
+        if doc.exists:
+            data = doc.to_dict() or {}
+            status.success_ids = set(data.get("success_ids", []))
+            status.failed_ids = set(data.get("failed_ids", []))
+            status.captcha_failed_ids = set(data.get("captcha_failed_ids", []))
+            return status
+
+        # 舊資料沒有摘要文件：讀一次子集合並補寫，之後就只需讀摘要
+        success_docs = await firestore_stream(
+            db.collection("success_redeems").document(f"{guild_id}_{code}").collection("players")
+        )
+        failed_docs = await firestore_stream(
+            db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players")
+        )
+        status.success_ids = {d.id for d in success_docs}
+        status.failed_ids = {d.id for d in failed_docs}
+        status.captcha_failed_ids = {
+            d.id for d in failed_docs if is_captcha_failure((d.to_dict() or {}).get("reason", ""))
+        }
+        if success_docs or failed_docs:
+            logger.info(f"[RedeemStatus] 由子集合回填摘要文件 {status.ref.id}（success={len(success_docs)} failed={len(failed_docs)}）")
+            await firestore_set(status.ref, {
+                "success_ids": sorted(status.success_ids),
+                "failed_ids": sorted(status.failed_ids),
+                "captcha_failed_ids": sorted(status.captcha_failed_ids),
+                "updated_at": datetime.now(timezone.utc)
+            })
+        return status
+
+    def record_success(self, pid):
+        self.success_ids.add(pid)
+        self.failed_ids.discard(pid)
+        self.captcha_failed_ids.discard(pid)
+        self._added["success_ids"].add(pid)
+        self._removed["failed_ids"].add(pid)
+        self._removed["captcha_failed_ids"].add(pid)
+
+    def record_failure(self, pid, reason):
+        self.failed_ids.add(pid)
+        self._added["failed_ids"].add(pid)
+        if is_captcha_failure(reason):
+            self.captcha_failed_ids.add(pid)
+            self._added["captcha_failed_ids"].add(pid)
+        else:
+            self.captcha_failed_ids.discard(pid)
+            self._removed["captcha_failed_ids"].add(pid)
+
+    def stage(self, writer):
+        """把累積的異動寫進 writer（作為 FirestoreBatchWriter 的 on_flush）"""
+        added = {k: sorted(v) for k, v in self._added.items() if v}
+        # 同一欄位不能在一次寫入同時 union 與 remove，移除另寫一筆
+        removed = {k: sorted(v) for k, v in self._removed.items() if v}
+        if added:
+            data = {k: firestore.ArrayUnion(v) for k, v in added.items()}
+            data["updated_at"] = datetime.now(timezone.utc)
+            writer.set(self.ref, data, merge=True, label=f"status:{self.ref.id}")
+        if removed:
+            writer.set(self.ref, {k: firestore.ArrayRemove(v) for k, v in removed.items()},
+                       merge=True, label=f"status:{self.ref.id}")
+        for v in self._added.values():
+            v.clear()
+        for v in self._removed.values():
+            v.clear()
+
+# === 併發設定（可由環境變數或單次任務 payload 覆寫）===
+MAX_REDEEM_CONCURRENCY = max(1, int(os.getenv("MAX_REDEEM_CONCURRENCY", "16")))
+DEFAULT_REDEEM_CONCURRENCY = int(os.getenv("REDEEM_CONCURRENCY", "4"))
+DEFAULT_FETCH_LIMIT = int(os.getenv("REDEEM_FETCH_CONCURRENCY", "2"))
+REDEEM_JOB_WORKERS = max(0, int(os.getenv("REDEEM_JOB_WORKERS", "1")))  # 本行程的任務佇列 worker 數，0 = 只收單不執行
+
+def clamp_concurrency(value, default):
+    """把 payload / 環境變數的併發數限制在 1..MAX_REDEEM_CONCURRENCY"""
+    try:
+        value = int(value) if value is not None else int(default)
+    except (TypeError, ValueError):
+        value = int(default)
+    return max(1, min(MAX_REDEEM_CONCURRENCY, value))
+
+# === 共用 Chromium（行程層級）===
+# Playwright 物件綁定建立它的事件迴圈，而各 API / 任務各自 new_event_loop，
+# 因此瀏覽器固定跑在一條專屬背景迴圈上，其他迴圈透過 run_coroutine_threadsafe 轉送。
+BROWSER_POOL_SIZE = max(1, int(os.getenv("BROWSER_POOL_SIZE", "1")))
+BROWSER_LAUNCH_ARGS = ["--disable-gpu", "--no-sandbox", "--disable-dev-shm-usage"]
+
+class BackgroundLoop:
+    """在 daemon thread 上常駐的事件迴圈"""
+
+    def __init__(self, name):
+        self.name = name
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True).start()
+            return self._loop
+
+    async def run(self, coro):
+        """在背景迴圈執行 coroutine，並從呼叫端迴圈等待結果（取消會一併傳遞）"""
+        target = self.loop
+        try:
+            if asyncio.get_running_loop() is target:
+                return await coro
+        except RuntimeError:
+            pass
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, target))
+
+# === 資源攔截：兌換 / 查名稱只需要 HTML、JS、CSS、API 與驗證碼圖，其餘一律擋掉 ===
+BLOCK_PAGE_RESOURCES = os.getenv("BLOCK_PAGE_RESOURCES", "1") != "0"
+ALLOWED_RESOURCE_TYPES = set(filter(None, os.getenv(
+    "ALLOWED_RESOURCE_TYPES", "document,script,stylesheet,xhr,fetch"
+).split(",")))
+CAPTCHA_IMAGE_PATTERN = re.compile(os.getenv("CAPTCHA_IMAGE_PATTERN", r"captcha|verify"), re.I)
+BLOCKED_HOSTS = [h.strip() for h in os.getenv(
+    "BLOCKED_HOSTS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,facebook.net,facebook.com,hotjar.com,clarity.ms,sentry.io",
+).split(",") if h.strip()]
+class ResourceFilter:
+    """context.route 的處理函式：白名單以外的請求直接 abort，並依資源類型計數（不另外連線量測大小）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def allows(self, request):
+        host = (urllib.parse.urlsplit(request.url).hostname or "").lower()
+        if any(host == h or host.endswith("." + h) for h in BLOCKED_HOSTS):
+            return False
+        if request.resource_type in ALLOWED_RESOURCE_TYPES:
+            return True
+        return request.resource_type == "image" and bool(CAPTCHA_IMAGE_PATTERN.search(request.url))
+
+    async def handle(self, route):
+        request = route.request
+        if self.allows(request):
+            with self._lock:
+                self._stats["allowed"] += 1
+            await route.continue_()
+            return
+
+        with contextlib.suppress(Exception):
+            await route.abort()
+        with self._lock:
+            self._stats["blocked"] += 1
+            self._stats[f"blocked_{request.resource_type}"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": BLOCK_PAGE_RESOURCES, **dict(self._stats)}
+
+RESOURCE_FILTER = ResourceFilter()
+
+class BrowserManager:
+    """常駐少量 Chromium，逐玩家只發放獨立的 BrowserContext"""
+
+    def __init__(self, size=BROWSER_POOL_SIZE):
+        self.size = size
+        self.runner = BackgroundLoop("browser-loop")
+        self._playwright = None
+        self._browsers = []
+        self._next = 0
+        self._launch_lock = None
+        self.launches = 0
+        self.contexts_created = 0
+
+    async def _get_browser(self):
+        # 只會在 browser-loop 上呼叫
+        if self._launch_lock is None:
+            self._launch_lock = asyncio.Lock()
+        async with self._launch_lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            # 移除已斷線（crash / 被 kill）的瀏覽器
+            self._browsers = [b for b in self._browsers if b.is_connected()]
+            if len(self._browsers) < self.size:
+                browser = await self._playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+                self._browsers.append(browser)
+                self.launches += 1
+                logger.info(f"[Browser] 啟動 Chromium #{self.launches}（常駐 {len(self._browsers)}/{self.size}）")
+                return browser
+            self._next = (self._next + 1) % len(self._browsers)
+            return self._browsers[self._next]
+
+    async def new_context(self, **kwargs):
+        kwargs.setdefault("locale", "zh-TW")
+        browser = await self._get_browser()
+        context = await browser.new_context(**kwargs)
+        if BLOCK_PAGE_RESOURCES:
+            await context.route("**/*", RESOURCE_FILTER.handle)
+        self.contexts_created += 1
+        return context
+
+    @contextlib.asynccontextmanager
+    async def context(self, **kwargs):
+        context = await self.new_context(**kwargs)
+        try:
+            yield context
+        finally:
+            with contextlib.suppress(Exception):
+                await context.close()
+
+    async def _shutdown(self):
+        for browser in self._browsers:
+            with contextlib.suppress(Exception):
+                await browser.close()
+        self._browsers = []
+        if self._playwright:
+            with contextlib.suppress(Exception):
+                await self._playwright.stop()
+            self._playwright = None
+
+    def shutdown(self):
+        if self.runner._loop is None or self.runner._loop.is_closed():
+            return
+        with contextlib.suppress(Exception):
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.runner._loop).result(timeout=10)
+
+    def stats(self):
+        return {
+            "browsers": len(self._browsers),
+            "pool_size": self.size,
+            "launches": self.launches,
+            "contexts_created": self.contexts_created,
+        }
+
+BROWSER_MANAGER = BrowserManager()
+atexit.register(BROWSER_MANAGER.shutdown)
+
+# === 預熱頁面池 ===
+GIFTCODE_URL = "https://wos-giftcode.centurygame.com/"
+WARM_PAGE_POOL_SIZE = max(0, int(os.getenv("WARM_PAGE_POOL_SIZE", str(DEFAULT_REDEEM_CONCURRENCY))))
+WARM_PAGE_MAX_AGE = int(os.getenv("WARM_PAGE_MAX_AGE", "300"))  # 秒，過舊的頁面丟棄重開
+
+class WarmPagePool:
+    """預先載入並停在登入表單的頁面；借出後整個 context 關閉，背景補回新的"""
+
+    def __init__(self, manager, size=WARM_PAGE_POOL_SIZE):
+        self.manager = manager
+        self.size = size
+        self._ready = collections.deque()  # (context, page, created_at)
+        self._filling = 0
+        self._tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    async def _open(self):
+        context = await self.manager.new_context()
+        try:
+            page = await context.new_page()
+            CAPTCHA_CAPTURE.attach(page)
+            await page.goto(GIFTCODE_URL, timeout=PAGE_LOAD_TIMEOUT)
+            await page.wait_for_selector('input[placeholder="角色ID"]', timeout=10000)
+        except Exception:
+            with contextlib.suppress(Exception):
+                await context.close()
+            raise
+        return context, page
+
+    async def _fill_one(self):
+        try:
+            context, page = await self._open()
+            self._ready.append((context, page, time.monotonic()))
+        except Exception as e:
+            logger.warning(f"[PagePool] 預熱頁面失敗：{e}")
+        finally:
+            self._filling -= 1
+
+    def _refill(self):
+        # 只在 browser-loop 上呼叫
+        while len(self._ready) + self._filling < self.size:
+            self._filling += 1
+            task = asyncio.ensure_future(self._fill_one())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def acquire(self):
+        """借出 (context, page)，page 已在登入表單；池空時當場開新頁"""
+        while self._ready:
+            context, page, created_at = self._ready.popleft()
+            if page.is_closed() or time.monotonic() - created_at > WARM_PAGE_MAX_AGE:
+                self.discarded += 1
+                with contextlib.suppress(Exception):
+                    await context.close()
+                continue
+            self.hits += 1
+            self._refill()
+            return context, page
+        self.misses += 1
+        self._refill()
+        return await self._open()
+
+    async def release(self, context):
+        # 已登入過的 context 不再重用，避免殘留角色狀態
+        with contextlib.suppress(Exception):
+            await context.close()
+        self._refill()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "ready": len(self._ready),
+            "filling": self._filling,
+            "hits": self.hits,
+            "misses": self.misses,
+            "discarded": self.discarded,
+        }
+
+PAGE_POOL = WarmPagePool(BROWSER_MANAGER)
+
+def on_browser_loop(func):
+    """裝飾 coroutine function：整段流程改在 browser-loop 上執行"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await BROWSER_MANAGER.runner.run(func(*args, **kwargs))
+    return wrapper
+
 FAILURE_KEYWORDS = ["請先輸入", "不存在", "錯誤", "無效", "超出", "無法", "類型"]
 RETRY_KEYWORDS = ["驗證碼錯誤", "伺服器繁忙", "請稍後再試", "系統異常", "請重試", "處理中"]
 SUCCESS_KEYWORDS = ["您已領取", "已兌換", "已領取過", "已經兌換", "超出兌換時間", "已使用", "已過期", "兌換成功，請在信件中領取獎勵！", "您已領取過", "暫不符合兌換要求"
 ]
 
+# 真的拿到獎勵（或已拿過）才算；「超出兌換時間」「暫不符合兌換要求」雖不再重試，但不能讓其他公會略過該玩家
+REDEEMED_KEYWORDS = ["兌換成功", "您已領取", "已領取過", "已兌換", "已經兌換"]
+
+# 含 SUCCESS_KEYWORDS 字樣但其實是失敗：「兌換碼已使用完畢」含「已使用」、「驗證碼已過期」含「已過期」
+NOT_SUCCESS_KEYWORDS = ["使用完畢", "次數已達上限", "驗證碼"]
+
 def is_success_reason(reason, message=""):
     combined_msg = (reason or "") + (message or "")
+    if any(k in combined_msg for k in NOT_SUCCESS_KEYWORDS):
+        return False
     return any(k in combined_msg for k in SUCCESS_KEYWORDS)
 
-REDEEM_RETRIES = 3
-# === 主流程 ===
-async def process_redeem(code, player_ids, guild_id, retry=False, fetch_semaphore=None):
-    logger.info(f"[process_redeem] 處理中：guild_id={guild_id} code={code} player_ids數量={len(player_ids)} retry={retry}")
-    # 在目前事件迴圈內建立 semaphore，避免「is bound to a different event loop」
-    fetch_semaphore = fetch_semaphore or asyncio.Semaphore(DEFAULT_FETCH_LIMIT)
-    start_time = time.time()
-    if not code or not player_ids or not guild_id:
-        logger.error("[process_redeem] 缺少必要參數，無法執行兌換")
-        return
-    is_retry = retry
-    logger.info(f"[Redeem] 開始處理 guild_id={guild_id} code={code} retry={retry} 人數={len(player_ids)}")
-    header = "Retry 兌換完成 / Retry Redemption Complete" if is_retry else "兌換完成 / Redemption Completed"
-    MAX_BATCH_SIZE = 1
-    all_success = []
-    all_fail = []
-    logger.info(f"[process_redeem] 傳入參數：code={code} player_ids={player_ids} guild_id={guild_id}")
-
-    # 先做前置抓名（加上單筆 timeout 與錯誤隔離，避免某些卡死讓整批卡住）
-    logger.info(f"[Redeem] 進入前置查名階段，共 {len(player_ids)} 個 ID")
-    FETCH_TIMEOUT = 20  # 秒
-
-    async def safe_fetch(pid):
+def is_redeemed_reason(reason, message=""):
+    combined_msg = (reason or "") + (message or "")
+    if any(k in combined_msg for k in NOT_SUCCESS_KEYWORDS):
+        return False
+    return any(k in combined_msg for k in REDEEMED_KEYWORDS)
+
+# 兌換碼層級的失敗：與玩家無關，任何人兌換都會得到同樣回覆
+REDEEM_CODE_PROBE = os.getenv("REDEEM_CODE_PROBE", "1") != "0"
+CODE_FAILURE_MARKERS = [
+    ("超出兌換時間", "expired"),
+    ("已過期", "expired"),
+    ("已使用完畢", "expired"),
+    ("次數已達上限", "expired"),
+    ("不存在", "nonexistent"),
+    ("無效", "nonexistent"),
+]
+CODE_FAILURE_LABELS = {"expired": "已過期", "nonexistent": "不存在或無效"}
+# 含這些字樣代表問題出在玩家 / 登入 / 驗證碼（例如「角色不存在」「驗證碼已過期」），不能據此判斷兌換碼
+PLAYER_FAILURE_MARKERS = ["角色", "登入", "驗證碼", "玩家"]
+
+def classify_code_failure(reason, message=""):
+    """回傳兌換碼層級的失敗類型（expired / nonexistent），玩家層級的失敗或成功回 None"""
+    combined_msg = (reason or "") + (message or "")
+    if any(k in combined_msg for k in PLAYER_FAILURE_MARKERS):
+        return None
+    for marker, kind in CODE_FAILURE_MARKERS:
+        if marker in combined_msg:
+            return kind
+    return None
+
+# === 兌換碼狀態登錄：多個公會常在幾分鐘內提交同一組兌換碼，結果跨任務共用 ===
+CODE_REGISTRY_TTL = {  # 秒
+    "valid": int(os.getenv("CODE_REGISTRY_TTL_VALID", "1800")),
+    "expired": int(os.getenv("CODE_REGISTRY_TTL_EXPIRED", str(7 * 86400))),
+    "nonexistent": int(os.getenv("CODE_REGISTRY_TTL_NONEXISTENT", "3600")),  # 新碼可能稍晚才上線，不宜存太久
+}
+CODE_STATUS_LABELS = {"valid": "可兌換", **CODE_FAILURE_LABELS}
+CODE_REGISTRY_RECHECK = int(os.getenv("CODE_REGISTRY_RECHECK", "60"))  # 秒，本地沒有定論時多久重讀 Firestore
+
+class GiftCodeRegistry:
+    """giftcode_registry/{code}：status（valid / expired / nonexistent）、first_seen 與 expires_at；
+    行程內另存一份；已確定失效的碼直接用本地結果，其餘每 CODE_REGISTRY_RECHECK 秒重讀一次，
+    才看得到其他 instance 寫入的結論"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._read_at = {}  # code → 上次讀 Firestore 的 monotonic 時間
+        self.hits = 0
+        self.misses = 0
+
+    def _ref(self, code):
+        return db.collection("giftcode_registry").document(code)
+
+    def _live(self, entry):
+        expires_at = (entry or {}).get("expires_at")
+        return entry.get("status") in CODE_REGISTRY_TTL and bool(expires_at) and expires_at > datetime.now(timezone.utc)
+
+    def get(self, code):
+        """回傳未過期的紀錄，沒有或已過期回 None（同步版，供 Flask route 使用）"""
+        with self._lock:
+            entry = self._entries.get(code)
+            read_at = self._read_at.get(code, 0)
+        settled = entry is not None and self._live(entry) and self.is_dead(entry)
+        if not settled and time.monotonic() - read_at >= CODE_REGISTRY_RECHECK:
+            try:
+                doc = self._ref(code).get()
+                remote = (doc.to_dict() or {}) if doc.exists else {}
+            except Exception as e:
+                logger.warning(f"[CodeRegistry] 讀取 {code} 失敗：{e}")
+                remote = None
+            with self._lock:
+                self._read_at[code] = time.monotonic()
+                if remote is not None:
+                    # 本地剛 put 過較新的結論時保留本地
+                    current = self._entries.get(code)
+                    if not current or not self._live(current) or (
+                        self._live(remote) and remote.get("checked_at") and current.get("checked_at")
+                        and remote["checked_at"] >= current["checked_at"]
+                    ):
+                        self._entries[code] = remote
+                entry = self._entries.get(code)
+        if entry and self._live(entry):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, code, status, message=""):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            previous = self._entries.get(code) or {}
+            entry = {
+                "code": code,
+                "status": status,
+                "message": message,
+                "first_seen": previous.get("first_seen") or now,
+                "checked_at": now,
+                "expires_at": now + timedelta(seconds=CODE_REGISTRY_TTL[status]),
+            }
+            self._entries[code] = entry
+            self._read_at[code] = time.monotonic()
         try:
-            await asyncio.wait_for(
-                fetch_and_store_if_missing(guild_id, pid, fetch_semaphore),
-                timeout=FETCH_TIMEOUT
-            )
-            return (pid, "ok", None)
-        except asyncio.TimeoutError:
-            logger.warning(f"[{pid}] fetch_and_store_if_missing timeout（{FETCH_TIMEOUT}s），略過此 ID 的前置抓取")
-            return (pid, "timeout", None)
+            self._ref(code).set(entry, merge=True)
         except Exception as e:
-            logger.warning(f"[{pid}] fetch_and_store_if_missing 發生例外：{e}")
-            return (pid, "error", str(e))
+            logger.warning(f"[CodeRegistry] 寫入 {code} 失敗：{e}")
+        logger.info(f"[CodeRegistry] {code} → {status}（{message}）")
+        return entry
 
-    safe_results = await asyncio.gather(*(safe_fetch(pid) for pid in player_ids))
-    timeouts = [pid for pid, status, _ in safe_results if status == "timeout"]
-    errors   = [pid for pid, status, _ in safe_results if status == "error"]
-    if timeouts or errors:
-        logger.info(f"[Redeem] 前置查名完成（timeouts={len(timeouts)} errors={len(errors)}）；將繼續後續流程")
+    async def lookup(self, code):
+        return await run_in_executor(functools.partial(self.get, code))
 
-    logger.info("準備讀取 success_redeems")
+    async def record(self, code, status, message=""):
+        return await run_in_executor(functools.partial(self.put, code, status, message))
 
-    success_docs = await firestore_stream(
-        db.collection("success_redeems").document(f"{guild_id}_{code}").collection("players")
-    )
-    logger.info(f"success_redeems 讀取完成，筆數：{len(success_docs)}")
-    already_redeemed_ids = {doc.id for doc in success_docs}
-    logger.info("準備讀取 failed_redeems")
-    failed_docs = await firestore_stream(
-        db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players")
-    )
-    logger.info(f"failed_redeems 讀取完成，筆數：{len(failed_docs)}")
-    failed_ids = {doc.id for doc in failed_docs}
+    def is_dead(self, entry):
+        return bool(entry) and entry.get("status") in CODE_FAILURE_LABELS
 
-    captcha_failed_ids = {
-        doc.id for doc in failed_docs
-        if "驗證碼三次辨識皆失敗" in (doc.to_dict() or {}).get("reason", "") or
-           "CAPTCHA failed 3 times" in (doc.to_dict() or {}).get("reason", "")
-    }
+    def stats(self):
+        with self._lock:
+            return {
+                "codes": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
 
-    filtered_player_ids = []
+CODE_REGISTRY = GiftCodeRegistry()
 
-    for pid in player_ids:
-        if pid in already_redeemed_ids:
-            continue
-        if not is_retry:
-            if pid in captcha_failed_ids:
-                continue
-        if is_retry:
-            logger.debug(f"[RetryCheck] {pid} 是否在 failed_ids：{pid in failed_ids}")
-            if pid in failed_ids:
-                filtered_player_ids.append(pid)
+REDEEM_RETRIES = 3
+
+# === 自適應速率控制（AIMD）===
+# 依網站回覆的節流訊息與逾時，加法增加 / 乘法減少全行程的兌換併發數與起始間隔
+ADAPTIVE_RATE = os.getenv("ADAPTIVE_RATE", "1") != "0"
+AIMD_INCREASE = float(os.getenv("AIMD_INCREASE", "1"))        # 每累積 limit 次順利回應，上限 +1
+AIMD_DECREASE = float(os.getenv("AIMD_DECREASE", "0.5"))      # 遇到節流，上限 ×0.5
+AIMD_COOLDOWN = float(os.getenv("AIMD_COOLDOWN", "5"))        # 秒，同一波節流只減一次
+AIMD_MAX_INTERVAL = float(os.getenv("AIMD_MAX_INTERVAL", "5"))  # 秒，兩次兌換起始的最大間隔
+THROTTLE_KEYWORDS = ["伺服器繁忙", "請稍後再試", "過於頻繁"]
+
+class AdaptiveRateController:
+    """跨任務共用的 AIMD 控制器；各任務跑在不同 thread 的事件迴圈上，因此以 threading.Lock 保護狀態"""
+
+    def __init__(self, initial=DEFAULT_REDEEM_CONCURRENCY, minimum=1, maximum=MAX_REDEEM_CONCURRENCY):
+        self._lock = threading.Lock()
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(maximum, initial)))
+        self.interval = 0.0
+        self.in_flight = 0
+        self._next_start = 0.0
+        self._ok_streak = 0
+        self._last_decrease = 0.0
+        self.throttles = collections.Counter()
+        self.increases = 0
+        self.decreases = 0
+
+    async def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.in_flight < int(self.limit) and now >= self._next_start:
+                    self.in_flight += 1
+                    self._next_start = now + self.interval
+                    return
+                wait = self._next_start - now if self.in_flight < int(self.limit) else 0.1
+            await asyncio.sleep(min(max(wait, 0.05), 1))
+
+    def release(self):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+    def share(self, parts):
+        """分給 parts 個子行程各自使用的 (起始上限, 最大上限)；加總不超過本行程目前的額度"""
+        with self._lock:
+            return max(1, int(self.limit) // parts), max(1, self.maximum // parts)
+
+    def resize(self, initial, maximum):
+        with self._lock:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = float(max(self.minimum, min(self.maximum, initial)))
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if not ADAPTIVE_RATE:
+            yield
+            return
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self):
+        with self._lock:
+            self._ok_streak += 1
+            if self._ok_streak >= self.limit:
+                self._ok_streak = 0
+                self.interval = max(0.0, self.interval - 0.25)
+                if self.limit < self.maximum:
+                    self.limit = min(self.maximum, self.limit + AIMD_INCREASE)
+                    self.increases += 1
+
+    def on_throttle(self, kind):
+        with self._lock:
+            self.throttles[kind] += 1
+            self._ok_streak = 0
+            now = time.monotonic()
+            if now - self._last_decrease < AIMD_COOLDOWN:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * AIMD_DECREASE)
+            self.interval = min(AIMD_MAX_INTERVAL, max(0.5, self.interval * 2))
+            self.decreases += 1
+            logger.info(f"[RateControl] 偵測到節流（{kind}）→ limit={self.limit:.1f} interval={self.interval:.2f}s")
+
+    def observe(self, text):
+        """依伺服器回覆分類：含節流字樣算 throttle，其餘算一次順利回應"""
+        if any(k in (text or "") for k in THROTTLE_KEYWORDS):
+            self.on_throttle("message")
         else:
-            if pid in failed_ids:
+            self.on_success()
+
+    def backoff(self, retry):
+        # 取代固定的 2 + retry 秒：節流越嚴重（interval 越大）等越久
+        return (2 + retry) * (1 + self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": ADAPTIVE_RATE,
+                "limit": round(self.limit, 2),
+                "interval": round(self.interval, 2),
+                "in_flight": self.in_flight,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "throttles": dict(self.throttles),
+            }
+
+RATE_CONTROLLER = AdaptiveRateController()
+
+# === 主流程 ===
+class RedeemRun:
+    """單一 (guild, code) 的兌換進度：過濾後待兌換的玩家、結果寫入與 webhook 報表"""
+
+    def __init__(self, guild_id, code, player_ids, retry=False):
+        self.guild_id = guild_id
+        self.code = code
+        self.player_ids = list(player_ids)
+        self.retry = retry
+        self.code_entry = None
+        self.status = None
+        self.roster = {}
+        self.filtered_player_ids = []
+        self.pending_ids = set()
+        self.skipped_count = 0
+        self.ledger_skipped = 0
+        self.ledger_ids = []  # 已在其他公會兌換成功、本公會尚無成功紀錄的玩家
+        self.ledger_added = set()  # 本次真正兌換到、待寫入跨公會紀錄的玩家
+        self.success_count = 0
+        self.all_fail = []  # 只保留 {"player_id", "reason"}，記憶體不隨 debug_logs 膨脹
+        self.code_failure = None  # (kind, 伺服器訊息)；兌換碼本身無效時其餘玩家不再處理
+
+    @property
+    def header(self):
+        return "Retry 兌換完成 / Retry Redemption Complete" if self.retry else "兌換完成 / Redemption Completed"
+
+    async def prepare(self, roster):
+        """讀狀態摘要與跨公會紀錄，算出這次真正要兌換的玩家"""
+        guild_id, code = self.guild_id, self.code
+        self.roster = roster
+
+        # 單一摘要文件取得已成功 / 已失敗 / 驗證碼失敗的 ID，不再逐筆讀子集合
+        self.status = await RedeemStatus.load(guild_id, code)
+        already_redeemed_ids = self.status.success_ids
+        failed_ids = self.status.failed_ids
+        captcha_failed_ids = self.status.captcha_failed_ids
+        logger.info(f"[Redeem] {guild_id}/{code} 狀態摘要讀取完成：success={len(already_redeemed_ids)} failed={len(failed_ids)} captcha_failed={len(captcha_failed_ids)}")
+        ledger_ids = await load_redeem_ledger(code, [pid for pid in self.player_ids if pid not in already_redeemed_ids])
+        logger.info(f"[Redeem] {guild_id}/{code} 跨公會兌換紀錄：{len(ledger_ids)} 人已在其他公會兌換成功")
+
+        for pid in self.player_ids:
+            if pid in already_redeemed_ids:
                 continue
-            filtered_player_ids.append(pid)
-    skipped_count = len(player_ids) - len(filtered_player_ids)
-    logger.info(f"[Redeem] filtered_player_ids：{len(filtered_player_ids)} 人，skipped_count={skipped_count}")
-
-    if not filtered_player_ids:
-        logger.info(f"[Redeem] filtered_player_ids 為空，觸發 webhook 發送並結束 guild_id={guild_id} code={code}")
-        summary_block = build_summary_block(
-            code=code,
-            success=0,
-            fail=0,
-            skipped=skipped_count,
-            duration=time.time() - start_time,
-            is_retry=retry
+            if pid in ledger_ids:
+                self.ledger_skipped += 1
+                self.ledger_ids.append(pid)
+                continue
+            if not self.retry:
+                if pid in captcha_failed_ids:
+                    continue
+            if self.retry:
+                logger.debug(f"[RetryCheck] {pid} 是否在 failed_ids：{pid in failed_ids}")
+                if pid in failed_ids:
+                    self.filtered_player_ids.append(pid)
+            else:
+                if pid in failed_ids:
+                    continue
+                self.filtered_player_ids.append(pid)
+        self.pending_ids = set(self.filtered_player_ids)
+        self.skipped_count = len(self.player_ids) - len(self.filtered_player_ids)
+        logger.info(f"[Redeem] {guild_id}/{code} filtered_player_ids：{len(self.filtered_player_ids)} 人，skipped_count={self.skipped_count}")
+
+    def stage_ledger(self, writer):
+        """作為 flush 前的彙總寫入：本 run 新增的跨公會成功紀錄"""
+        if self.ledger_added:
+            stage_redeem_ledger(writer, self.code, self.ledger_added)
+            self.ledger_added = set()
+
+    async def record_ledger_hits(self):
+        """跨公會紀錄命中的玩家：補寫本公會的成功紀錄並移出失敗名單，之後不再重送也不再計入 Ledger"""
+        if not self.ledger_ids:
+            return
+        guild_id, code = self.guild_id, self.code
+        writer = FirestoreBatchWriter(on_flush=self.status.stage)
+        for pid in self.ledger_ids:
+            writer.set(
+                db.collection("success_redeems").document(f"{guild_id}_{code}").collection("players").document(pid),
+                {
+                    "message": "已在其他公會兌換成功",
+                    "via_ledger": True,
+                    "timestamp": datetime.now(timezone.utc)
+                },
+                label=pid
+            )
+            writer.delete(
+                db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players").document(pid),
+                label=pid
+            )
+            self.status.record_success(pid)
+        await writer.flush()
+        logger.info(f"[Redeem] {guild_id}/{code} 已補寫 {len(self.ledger_ids)} 筆跨公會成功紀錄")
+
+    def record(self, r, writer):
+        """把單一玩家的結果寫進 writer 並更新統計；同一玩家只記一次"""
+        guild_id, code = self.guild_id, self.code
+        pid = r.get("player_id")
+        if pid not in self.pending_ids:
+            return
+        self.pending_ids.discard(pid)
+        reason = str(r.get("reason") or "")
+        message = str(r.get("message") or "")
+        logger.debug(f"[DEBUG] 判斷 success：pid={pid} code={code} reason={reason} message={message} -> {is_success_reason(reason, message)}")
+
+        if is_success_reason(reason, message):
+            self.success_count += 1
+            logger.info(f"[Firestore] 記錄成功 ID: {pid}，寫入 success_redeems（{guild_id}_{code}）")
+            writer.set(
+                db.collection("success_redeems").document(f"{guild_id}_{code}").collection("players").document(pid),
+                {
+                    "message": reason or message or "成功但無訊息",
+                    "timestamp": datetime.now(timezone.utc)
+                },
+                label=pid
+            )
+            if is_redeemed_reason(reason, message):
+                self.ledger_added.add(pid)
+            writer.delete(
+                db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players").document(pid),
+                label=pid
+            )
+            self.status.record_success(pid)
+        else:
+            name = self.roster[pid].get("name", "未知名稱") if pid in self.roster else "未知"
+            logger.info(f"[Firestore] 記錄失敗 ID: {pid}，寫入 failed_redeems（{guild_id}_{code}）")
+            writer.set(
+                db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players").document(pid),
+                {
+                    "name": name,
+                    "reason": reason or "未知錯誤",
+                    "updated_at": datetime.now(timezone.utc)
+                },
+                label=pid
+            )
+            self.status.record_failure(pid, reason or "未知錯誤")
+            self.all_fail.append({"player_id": pid, "reason": reason or "未知錯誤"})
+
+    def _summary_block(self, duration, success=0, fail=0, skipped=None):
+        return build_summary_block(
+            code=self.code,
+            success=success,
+            fail=fail,
+            skipped=self.skipped_count if skipped is None else skipped,
+            duration=duration,
+            is_retry=self.retry,
+            ledger_skipped=self.ledger_skipped
         )
-        full_block = f"{summary_block}\n\n所有 ID 皆已兌換成功或已領取過，無需再處理"
-        msg = f"{header}\n```text\n{textwrap.indent(full_block, '  ')}\n```"
 
-        webhook_url = get_webhook_url_by_guild(guild_id)
+    def report_cached_verdict(self, duration):
+        """其他公會剛驗證過已失效的兌換碼：直接回報快取結果，不登入任何玩家"""
+        entry = self.code_entry
+        logger.info(f"[Redeem] 兌換碼 {self.code} 已知{CODE_STATUS_LABELS[entry['status']]}，略過 {len(self.player_ids)} 位玩家")
+        full_block = (
+            f"{self._summary_block(duration, skipped=len(self.player_ids))}\n\n"
+            f"⚠️ 兌換碼{CODE_STATUS_LABELS[entry['status']]}：{entry.get('message') or entry['status']}\n"
+            f"（快取結果，未重新兌換 / Cached verdict, no redemption attempted）"
+        )
+        webhook_url = get_webhook_url_by_guild(self.guild_id)
         if webhook_url:
-            send_long_webhook(webhook_url, msg)
-        return
+            send_long_webhook(webhook_url, f"{self.header}\n```text\n{textwrap.indent(full_block, '  ')}\n```")
 
-    # ✅ 改為平行非同步兌換
-    sema = fetch_semaphore
+    def report_nothing_to_do(self, duration):
+        logger.info(f"[Redeem] filtered_player_ids 為空，觸發 webhook 發送並結束 guild_id={self.guild_id} code={self.code}")
+        full_block = f"{self._summary_block(duration)}\n\n所有 ID 皆已兌換成功或已領取過，無需再處理"
+        webhook_url = get_webhook_url_by_guild(self.guild_id)
+        if webhook_url:
+            send_long_webhook(webhook_url, f"{self.header}\n```text\n{textwrap.indent(full_block, '  ')}\n```")
+
+    async def report(self, duration):
+        guild_id, code = self.guild_id, self.code
+        summary_block = self._summary_block(duration, success=self.success_count, fail=len(self.all_fail))
+        logger.info(f"[Redeem] 完成處理 guild_id={guild_id} code={code} 成功={self.success_count} 失敗={len(self.all_fail)} 跳過={self.skipped_count}")
+        failures_block = await format_failures_block(guild_id, self.all_fail, roster=self.roster)
+        abort_notice = ""
+        if self.code_failure:
+            kind, message = self.code_failure
+            aborted_count = len(self.pending_ids)
+            abort_notice = (
+                f"⚠️ 兌換碼{CODE_FAILURE_LABELS[kind]}：{message}\n"
+                f"已中止其餘 {aborted_count} 位玩家 / Code {kind}, {aborted_count} players not attempted\n\n"
+            )
+        full_block = f"{summary_block}\n\n{abort_notice}{failures_block.strip() or '無錯誤資料 / No error data'}"
 
-    async def limited_redeem(pid):
-        async with sema:
+        # 優先使用 guild 專屬 webhook，其次使用全域
+        webhook_url = get_webhook_url_by_guild(guild_id) or os.getenv("ADD_ID_WEBHOOK_URL")
+        if webhook_url:
             try:
-                result = await run_redeem_with_retry(pid, code, guild_id)
+                for i in range(0, len(full_block), 1800):
+                    content = f"{self.header}\n```text\n{full_block[i:i+1800]}\n```"
+                    requests.post(webhook_url, json={"content": content}, timeout=10)
+                logger.info(f"[Webhook] 兌換結束總結已發送")
             except Exception as e:
-                logger.error(f"[{pid}] ❌ limited_redeem 捕捉到例外：{e}")
-                result = None
+                logger.warning(f"[Webhook] 發送兌換結束總結失敗：{e}")
 
-            if result is None or not isinstance(result, dict):
-                logger.warning(f"[{pid}] ❌ limited_redeem 收到 None 或非 dict，強制包裝")
-                result = {
-                    "player_id": pid,
-                    "success": False,
-                    "reason": str(result) if result else "NoneType error",
-                    "debug_logs": []
-                }
-
-            # 補強欄位，防止缺欄造成 Firestore 寫入失敗
-            result.setdefault("player_id", pid)
-            result.setdefault("success", False)
-            result.setdefault("reason", "")
-            result.setdefault("message", "")
-            result.setdefault("debug_logs", [])
+async def process_redeem(code, player_ids, guild_id, retry=False, concurrency=None, engine=None, processes=None):
+    """code 可為單一兌換碼或兌換碼清單；多組兌換碼時每位玩家只登入一次"""
+    codes = [code] if isinstance(code, str) else list(dict.fromkeys(c for c in (code or []) if c))
+    logger.info(f"[process_redeem] 處理中：guild_id={guild_id} codes={codes} player_ids數量={len(player_ids or [])} retry={retry}")
+    if not codes or not player_ids or not guild_id:
+        logger.error("[process_redeem] 缺少必要參數，無法執行兌換")
+        return
+    logger.info(f"[Redeem] 開始處理 guild_id={guild_id} codes={codes} retry={retry} 人數={len(player_ids)}")
+    logger.info(f"[process_redeem] 傳入參數：codes={codes} player_ids={player_ids} guild_id={guild_id}")
+    runs = [RedeemRun(guild_id, c, player_ids, retry=retry) for c in codes]
+    await redeem_runs(runs, concurrency=concurrency, engine=engine, processes=processes)
+
+async def redeem_runs(runs, concurrency=None, engine=None, processes=None):
+    """執行多個 (guild, code) 兌換：同一玩家的所有待兌換碼在一次登入內完成，結果寫回每個相關的 run"""
+    # 未指定併發時，若有自適應控制則開到上限，由 RATE_CONTROLLER 決定實際同時數
+    concurrency = clamp_concurrency(concurrency, MAX_REDEEM_CONCURRENCY if ADAPTIVE_RATE else DEFAULT_REDEEM_CONCURRENCY)
+    start_time = time.time()
 
-            return result
+    # 已知失效的兌換碼直接回報快取結果
+    live_runs = []
+    for run in runs:
+        run.code_entry = await CODE_REGISTRY.lookup(run.code)
+        if CODE_REGISTRY.is_dead(run.code_entry):
+            run.report_cached_verdict(time.time() - start_time)
+        else:
+            live_runs.append(run)
+
+    # 每個公會一次讀回本批玩家的名冊資料，失敗紀錄與 webhook 報表共用
+    rosters = {}
+    for run in live_runs:
+        if run.guild_id not in rosters:
+            guild_ids = dict.fromkeys(pid for r in live_runs if r.guild_id == run.guild_id for pid in r.player_ids)
+            rosters[run.guild_id] = await load_roster(run.guild_id, list(guild_ids))
+            logger.info(f"[Redeem] 名冊快照讀取完成：{run.guild_id} {len(rosters[run.guild_id])}/{len(guild_ids)} 筆")
+        await run.prepare(rosters[run.guild_id])
+        await run.record_ledger_hits()
+
+    active_runs = []
+    for run in live_runs:
+        if run.filtered_player_ids:
+            active_runs.append(run)
+        else:
+            run.report_nothing_to_do(time.time() - start_time)
+    if not active_runs:
+        return
 
-    logger.info(f"[Redeem] 開始平行處理 {len(filtered_player_ids)} 位玩家")
+    # 玩家 → 待兌換的兌換碼（依提交順序）；同一玩家跨 run 只登入一次
+    wanted = {}
+    runs_by_code = collections.defaultdict(list)
+    for run in active_runs:
+        runs_by_code[run.code].append(run)
+        for pid in run.filtered_player_ids:
+            codes = wanted.setdefault(pid, [])
+            if run.code not in codes:
+                codes.append(run.code)
+    guild_hint = active_runs[0].guild_id if len({r.guild_id for r in active_runs}) == 1 else None
+
+    # ✅ 平行兌換：concurrency 個 worker 從佇列取玩家（或分片給多個行程），結果一完成就寫入，不等整批結束
+    processes = max(1, int(processes if processes is not None else REDEEM_PROCESS_WORKERS))
+    use_processes = processes > 1 and len(wanted) >= REDEEM_SHARD_MIN_PLAYERS
+    logger.info(f"[Redeem] 開始平行處理 {len(wanted)} 位玩家 / {len(runs_by_code)} 組兌換碼（concurrency={concurrency} engine={resolve_engine(engine)} processes={processes if use_processes else 1}）")
+
+    def stage_statuses(w):
+        for run in active_runs:
+            run.status.stage(w)
+            run.stage_ledger(w)
+
+    writer = FirestoreBatchWriter(on_flush=stage_statuses)
+    pending = collections.deque()
+    results_queue = asyncio.Queue()
+    dead_codes = {}  # code -> (kind, 伺服器訊息)
+    profiled = set()  # (guild_id, pid)：名稱 / 王國每個公會只寫一次
+
+    def codes_for(pid):
+        return [c for c in wanted[pid] if c not in dead_codes]
+
+    async def worker():
+        while pending:
+            pid = pending.popleft()
+            codes = codes_for(pid)
+            if not codes:
+                continue
+            try:
+                for r in await redeem_player(pid, codes, guild_hint, engine=engine):
+                    await results_queue.put(r)
+            except Exception as e:
+                logger.error(f"[{pid}] ❌ worker 捕捉到例外：{e}")
+                for c in codes:
+                    await results_queue.put({"player_id": pid, "code": c, "success": False, "reason": str(e)})
 
-    results = await asyncio.gather(
-        *(limited_redeem(pid) for pid in filtered_player_ids),
-        return_exceptions=True
-    )
-    for r in results:
-        logger.debug(f"[DEBUG] 任務回傳結果 r = {r}")
+    async def run_workers():
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(concurrency, len(pending)))))
+        finally:
+            await results_queue.put(None)
 
-        if isinstance(r, Exception):
-            logger.error(f"[process_all] 任務發生例外，自動包裝：{r}")
-            r = {
-                "player_id": "Unknown",
-                "success": False,
-                "reason": str(r),
-                "debug_logs": []
-            }
+    async def run_shards():
+        try:
+            jobs = [(pid, codes_for(pid)) for pid in pending]
+            async for r in redeem_in_processes([j for j in jobs if j[1]], guild_hint, engine, concurrency, processes):
+                await results_queue.put(r)
+        finally:
+            await results_queue.put(None)
+
+    async def record_result(r):
+        pid, code = r.get("player_id"), r.get("code")
+        # 兌換登入時順便帶回的名稱與王國，寫進每個登記此玩家的公會
+        profile = r.pop("profile", None)
+        if profile:
+            for run in active_runs:
+                key = (run.guild_id, pid)
+                if pid not in run.pending_ids or key in profiled:
+                    continue
+                profiled.add(key)
+                roster = rosters[run.guild_id]
+                if await store_player_profile(run.guild_id, pid, profile.get("name"), profile.get("kingdom"),
+                                              existing=roster.get(pid, {}), writer=writer):
+                    roster.setdefault(pid, {}).update(name=profile["name"], kingdom=profile["kingdom"])
+        for run in runs_by_code.get(code, []):
+            run.record(r, writer)
+
+    def check_code_failure(r):
+        """回傳這筆結果是否讓某組兌換碼被判定為失效"""
+        code = r.get("code")
+        kind = classify_code_failure(str(r.get("reason") or ""), str(r.get("message") or ""))
+        if not kind or code in dead_codes:
+            return False
+        dead_codes[code] = (kind, str(r.get("reason") or r.get("message") or ""))
+        for run in runs_by_code.get(code, []):
+            run.code_failure = dead_codes[code]
+        logger.warning(f"[Redeem] 兌換碼 {code} {CODE_FAILURE_LABELS[kind]}（{dead_codes[code][1]}），中止其餘玩家 / Code {kind}, aborting batch")
+        return True
 
-        if not isinstance(r, dict):
-            logger.error(f"[process_all] 任務回傳非 dict，自動包裝：{r}")
-            r = {
-                "player_id": "Unknown",
+    # 中途被中斷時已完成的結果仍會在 finally 寫出，下一次執行只會處理尚未完成的 ID
+    producer = None
+    try:
+        probed = set()
+        # 先用一位玩家試兌：兌換碼打錯或過期時只花一次登入與驗證碼；近期已確認可用的兌換碼不必再試兌
+        if REDEEM_CODE_PROBE and len(wanted) > 1:
+            for code in [c for c, code_runs in runs_by_code.items() if not code_runs[0].code_entry]:
+                if code in dead_codes or any(code in wanted[p] for p in probed):
+                    continue
+                probe_pid = next(p for p in wanted if code in wanted[p])
+                probed.add(probe_pid)
+                logger.info(f"[Redeem] 以 {probe_pid} 試兌兌換碼 {codes_for(probe_pid)}")
+                for r in await redeem_player(probe_pid, codes_for(probe_pid), guild_hint, engine=engine):
+                    await record_result(r)
+                    check_code_failure(r)
+
+        pending.extend(pid for pid in wanted if pid not in probed and codes_for(pid))
+        if pending:
+            producer = asyncio.ensure_future(run_shards() if use_processes else run_workers())
+            while True:
+                try:
+                    r = await asyncio.wait_for(results_queue.get(), timeout=writer.flush_interval)
+                except asyncio.TimeoutError:
+                    await writer.maybe_flush()
+                    continue
+                if r is None:
+                    break
+                await record_result(r)
+                if check_code_failure(r) and len(dead_codes) == len(runs_by_code) and pending:
+                    # 所有兌換碼都失效：worker 不再取新玩家，只收完進行中的結果；分片則直接結束子行程
+                    pending.clear()
+                    if use_processes:
+                        break
+                await writer.maybe_flush()
+    finally:
+        if producer and not producer.done():
+            producer.cancel()
+        await writer.flush()
+    logger.info(f"[Firestore] 兌換結果寫入完成：commits={writer.commits} 個別錯誤={len(writer.errors)}")
+
+    for code, code_runs in runs_by_code.items():
+        if code in dead_codes:
+            await CODE_REGISTRY.record(code, *dead_codes[code])
+        elif any(run.success_count for run in code_runs) and not code_runs[0].code_entry:
+            await CODE_REGISTRY.record(code, "valid", "兌換成功")
+
+    for run in active_runs:
+        await run.report(time.time() - start_time)
+
+async def redeem_player(pid, codes, guild_id=None, engine=None):
+    """單一玩家完整兌換 codes（含重試），回傳每組兌換碼補齊欄位的結果清單；
+    登入時帶回的名稱 / 王國放在第一筆結果的 result["profile"]"""
+    profile = {}
+    try:
+        results = await run_redeem_with_retry(pid, codes, guild_id, engine=engine, profile=profile)
+    except Exception as e:
+        logger.error(f"[{pid}] ❌ redeem_player 捕捉到例外：{e}")
+        results = {}
+
+    normalized = []
+    for code in codes:
+        result = results.get(code)
+        if result is None or not isinstance(result, dict):
+            logger.warning(f"[{pid}] ❌ redeem_player 收到 None 或非 dict，強制包裝")
+            result = {
+                "player_id": pid,
                 "success": False,
-                "reason": str(r) if r else "None or invalid return",
+                "reason": str(result) if result else "NoneType error",
                 "debug_logs": []
             }
 
-        pid = r.get("player_id")
-        if not pid or pid == "Unknown":
-            logger.warning(f"[Redeem] 無法辨識 player_id，略過 Firestore 寫入：{r}")
-            continue
+        # 補強欄位，防止缺欄造成 Firestore 寫入失敗
+        result = dict(result)
+        result["code"] = code
+        result.setdefault("player_id", pid)
+        result.setdefault("success", False)
+        result.setdefault("reason", "")
+        result.setdefault("message", "")
+        result.setdefault("debug_logs", [])
+        normalized.append(result)
+    if normalized:
+        normalized[0]["profile"] = profile
+    return normalized
+
+# === 多行程分片：每個行程有自己的事件迴圈與瀏覽器池，結果經 multiprocessing.Queue 回傳 ===
+REDEEM_PROCESS_WORKERS = max(1, int(os.getenv("REDEEM_PROCESS_WORKERS", "1")))
+REDEEM_SHARD_MIN_PLAYERS = int(os.getenv("REDEEM_SHARD_MIN_PLAYERS", "20"))  # 人數太少不值得開行程
+_SHARD_DONE = "__shard_done__"
+
+def _redeem_shard_main(index, jobs, guild_id, engine, concurrency, result_queue, rate_share=None):
+    """子行程進入點（spawn）：以 concurrency 個 worker 跑完分到的 (玩家, 兌換碼清單)"""
+    if rate_share:
+        # 子行程各有一份 RATE_CONTROLLER：只拿父行程額度的 1/N，全部子行程合計不超過父行程的上限
+        RATE_CONTROLLER.resize(*rate_share)
+
+    async def run():
+        pending = collections.deque(jobs)
+
+        async def worker():
+            while pending:
+                pid, codes = pending.popleft()
+                for r in await redeem_player(pid, codes, guild_id, engine=engine):
+                    # 只回傳寫入與報表需要的欄位，debug 內容留在子行程
+                    result_queue.put({k: r.get(k) for k in ("player_id", "code", "success", "reason", "message", "profile")})
 
-        reason = str(r.get("reason", "") if isinstance(r, dict) else r or "")
-        message = str(r.get("message", "") if isinstance(r, dict) else "")
-        logger.debug(f"[DEBUG] 判斷 success：pid={pid} reason={reason} message={message} -> {is_success_reason(reason, message)}")
-
-        if is_success_reason(reason, message):
-            all_success.append(r)
-            logger.info(f"[Firestore] 記錄成功 ID: {pid}，寫入 success_redeems")
-            try:
-                logger.debug(f"[Firestore] 寫入前：{pid} 到 success/failed_redeems")
-                await firestore_set(
-                    db.collection("success_redeems").document(f"{guild_id}_{code}").collection("players").document(r["player_id"]),
-                    {
-                        "message": reason or message or "成功但無訊息",
-                        "timestamp": datetime.now(timezone.utc)
-                    }
-                )
-                await firestore_delete(
-                    db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players").document(r["player_id"])
-                )
-            except Exception as e:
-                logger.warning(f"[Firestore] ✅ 成功寫入或刪除時發生錯誤：{pid} error={e}")
-        else:
-            doc = await firestore_get(db.collection("ids").document(guild_id).collection("players").document(r["player_id"]))
-            name = doc.to_dict().get("name", "未知名稱") if doc.exists else "未知"
-            logger.info(f"[Firestore] 記錄失敗 ID: {pid}，寫入 failed_redeems")
-            try:
-                logger.debug(f"[Firestore] 寫入前：{pid} 到 success/failed_redeems")
-                await firestore_set(
-                    db.collection("failed_redeems").document(f"{guild_id}_{code}").collection("players").document(r["player_id"]),
-                    {
-                        "name": name,
-                        "reason": reason or "未知錯誤",
-                        "updated_at": datetime.now(timezone.utc)
-                    }
-                )
-            except Exception as e:
-                logger.warning(f"[Firestore] ❌ 失敗寫入時發生錯誤：{pid} error={e}")
-            all_fail.append(r)
-    summary_block = build_summary_block(
-        code=code,
-        success=len(all_success),
-        fail=len(all_fail),
-        skipped=skipped_count,
-        duration=time.time() - start_time,
-        is_retry=retry
-    )
-    logger.info(f"[Redeem] 完成處理 guild_id={guild_id} code={code} 成功={len(all_success)} 失敗={len(all_fail)} 跳過={skipped_count}")
-    failures_block = await format_failures_block(guild_id, all_fail)
-    full_block = f"{summary_block}\n\n{failures_block.strip() or '無錯誤資料 / No error data'}"
-    webhook_message = f"{header}\n```text\n{textwrap.indent(full_block, '  ')}\n```"
-
-    # 優先使用 guild 專屬 webhook，其次使用全域
-    webhook_url = get_webhook_url_by_guild(guild_id) or os.getenv("ADD_ID_WEBHOOK_URL")
-    if webhook_url:
         try:
-            for i in range(0, len(full_block), 1800):
-                content = f"{header}\n```text\n{full_block[i:i+1800]}\n```"
-                requests.post(webhook_url, json={"content": content}, timeout=10)
-            logger.info(f"[Webhook] 兌換結束總結已發送")
-        except Exception as e:
-            logger.warning(f"[Webhook] 發送兌換結束總結失敗：{e}")
+            await asyncio.gather(*(worker() for _ in range(min(concurrency, len(jobs)))))
+        finally:
+            await close_http_connector()
 
-async def run_redeem_with_retry(player_id, code, guild_id, debug=False):
-    logger.info(f"[Redeem] {player_id} 開始兌換 retries={REDEEM_RETRIES}")
+    try:
+        asyncio.run(run())
+    except Exception:
+        logger.error(f"[Shard {index}] 子行程執行失敗\n{traceback.format_exc()}")
+    finally:
+        BROWSER_MANAGER.shutdown()
+        result_queue.put((_SHARD_DONE, index, dict(RATE_CONTROLLER.throttles)))
+
+def _stop_shards(procs, timeout=5):
+    """終止仍在執行的子行程；所有子行程共用同一個 join 期限"""
+    for proc in procs:
+        if proc.is_alive():
+            proc.terminate()
+    deadline = time.monotonic() + timeout
+    for proc in procs:
+        proc.join(timeout=max(0, deadline - time.monotonic()))
+
+async def redeem_in_processes(jobs, guild_id, engine, concurrency, processes):
+    """把 (玩家, 兌換碼清單) 輪流分到 processes 個子行程，依完成順序 yield 結果；
+    子行程異常結束時未回報的玩家 / 兌換碼以失敗回傳"""
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    shards = [s for s in (jobs[i::processes] for i in range(processes)) if s]
+    rate_share = RATE_CONTROLLER.share(len(shards))
+    procs = [
+        ctx.Process(
+            target=_redeem_shard_main,
+            args=(i, shard, guild_id, engine, concurrency, result_queue, rate_share),
+            name=f"redeem-shard-{i}",
+            daemon=True
+        )
+        for i, shard in enumerate(shards)
+    ]
+    for proc in procs:
+        proc.start()
+    logger.info(f"[Shard] 啟動 {len(procs)} 個子行程，每個 concurrency={concurrency} rate_limit={rate_share[0]}/{rate_share[1]}")
+
+    loop = asyncio.get_running_loop()
+    remaining = len(procs)
+    seen = set()
+    try:
+        while remaining:
+            try:
+                item = await loop.run_in_executor(None, functools.partial(result_queue.get, timeout=5))
+            except queue.Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    logger.warning("[Shard] 子行程皆已結束但尚未收齊結果")
+                    break
+                continue
+            if isinstance(item, tuple) and item[0] == _SHARD_DONE:
+                remaining -= 1
+                # 子行程遇到的節流回饋給父行程，之後的任務（與下一次分片的額度）跟著降速
+                for kind, count in item[2].items():
+                    for _ in range(count):
+                        RATE_CONTROLLER.on_throttle(f"shard:{kind}")
+                continue
+            seen.add((item["player_id"], item["code"]))
+            yield item
+    finally:
+        # join 會阻塞，改在 executor 執行，避免提前中止時卡住事件迴圈上的寫入與 flush
+        await run_in_executor(functools.partial(_stop_shards, procs))
+
+    for pid, codes in jobs:
+        for code in codes:
+            if (pid, code) not in seen:
+                yield {"player_id": pid, "code": code, "success": False, "reason": "例外錯誤：子行程異常結束", "message": ""}
+
+async def run_redeem_with_retry(player_id, codes, guild_id, debug=False, engine=None, profile=None):
+    """同一位玩家兌換 codes，回傳 {code: result}；每一輪只把需要重試的兌換碼再登入兌換一次"""
+    redeem_once = _redeem_once_http if resolve_engine(engine) == "http" else _redeem_once
+    logger.info(f"[Redeem] {player_id} 開始兌換 codes={codes} retries={REDEEM_RETRIES} engine={resolve_engine(engine)}")
     logger.info(f"[Redeem] {player_id} run_redeem_with_retry 呼叫進入")
     debug_logs = []
-    result = None  # 確保最後 fallback 時也有值
+    results = {}
+    pending = list(codes)
 
     for redeem_retry in range(REDEEM_RETRIES + 1):
         try:
-            result = await asyncio.wait_for(
-                _redeem_once(player_id, code, debug_logs, redeem_retry, debug=debug),
-                timeout=90  # 每次單人兌換最多 90 秒
-            )
+            # 全域速率控制：同時進行的兌換數與起始間隔由 RATE_CONTROLLER 依節流訊號調整
+            async with RATE_CONTROLLER.slot():
+                batch = await asyncio.wait_for(
+                    redeem_once(player_id, pending, debug_logs, redeem_retry, debug=debug, profile=profile),
+                    timeout=90 * len(pending)  # 每組兌換碼最多 90 秒
+                )
         except asyncio.TimeoutError:
-            logger.error(f"[{player_id}] 第 {redeem_retry + 1} 次：超過 90 秒 timeout")
-            result = {
-                "player_id": player_id,
-                "success": False,
-                "reason": "Timeout：單人兌換超過 90 秒",
-                "debug_logs": debug_logs
-            }
+            RATE_CONTROLLER.on_throttle("timeout")
+            logger.error(f"[{player_id}] 第 {redeem_retry + 1} 次：超過 {90 * len(pending)} 秒 timeout")
+            for code in pending:
+                results[code] = {
+                    "player_id": player_id,
+                    "success": False,
+                    "reason": "Timeout：單人兌換超過 90 秒",
+                    "debug_logs": debug_logs
+                }
             break
 
-        if result is None:
-            logger.warning(f"[{player_id}] ❌ _redeem_once 最終仍為 None，自動補上錯誤格式")
-            result = {
-                "player_id": player_id,
-                "success": False,
-                "reason": "NoneType return from _redeem_once",
-                "debug_logs": debug_logs
-            }
+        retry_codes = []
+        transient_only = True
+        for code in pending:
+            result = (batch or {}).get(code)
+            if result is None:
+                logger.warning(f"[{player_id}] ❌ _redeem_once 最終仍為 None，自動補上錯誤格式")
+                result = {
+                    "player_id": player_id,
+                    "success": False,
+                    "reason": "NoneType return from _redeem_once",
+                    "debug_logs": debug_logs
+                }
 
-        # 確保 reason 至少有預設值
-        result["reason"] = result.get("reason") or "未知錯誤"
+            # 確保 reason 至少有預設值
+            result["reason"] = result.get("reason") or "未知錯誤"
+            results[code] = result
 
-        # 如果是暫時性嘗試標記，重試
-        if result["reason"].startswith("_try"):
-            await asyncio.sleep(1 + redeem_retry)
-            continue
+            # 如果是暫時性嘗試標記，重試
+            if result["reason"].startswith("_try"):
+                retry_codes.append(code)
+                continue
 
-        # 成功條件：直接回傳
-        if is_success_reason(result.get("reason", ""), result.get("message", "")):
-            return result
+            RATE_CONTROLLER.observe(f"{result.get('reason') or ''}{result.get('message') or ''}")
 
-        # 登入錯誤也是不重試
-        if "登入失敗" in (result.get("reason") or "") or "請先登入" in (result.get("reason") or ""):
-            return result
+            # 成功、登入錯誤與其他非暫時性錯誤都不重試
+            if is_success_reason(result.get("reason", ""), result.get("message", "")):
+                continue
+            if "登入失敗" in result["reason"] or "請先登入" in result["reason"]:
+                continue
 
-        # 可重試錯誤才等候後繼續
-        if any(k in (result.get("reason") or "") for k in RETRY_KEYWORDS):
-            debug_logs.append({
-                "retry": redeem_retry + 1,
-                "info": f"Retry due to: {result.get('reason')}"
-            })
-            await asyncio.sleep(2 + redeem_retry)
-        else:
-            # 其他錯誤直接回傳
-            return result
+            # 可重試錯誤才等候後繼續
+            if any(k in result["reason"] for k in RETRY_KEYWORDS):
+                debug_logs.append({
+                    "retry": redeem_retry + 1,
+                    "code": code,
+                    "info": f"Retry due to: {result.get('reason')}"
+                })
+                retry_codes.append(code)
+                transient_only = False
+
+        if not retry_codes or redeem_retry == REDEEM_RETRIES:
+            break
+        pending = retry_codes
+        await asyncio.sleep(1 + redeem_retry if transient_only else RATE_CONTROLLER.backoff(redeem_retry))
 
-    # 所有重試結束後，回傳最後一次的結果
-    return result
+    # 所有重試結束後，回傳每組兌換碼最後一次的結果
+    return results
 
-async def _redeem_once(player_id, code, debug_logs, redeem_retry, debug=False):
-    logger.info(f"[{player_id}] _redeem_once() 進入，開始兌換流程")
-    browser = None
+@on_browser_loop
+async def _redeem_once(player_id, codes, debug_logs, redeem_retry, debug=False, profile=None):
+    """登入一次後依序兌換 codes，回傳 {code: result}"""
+    logger.info(f"[{player_id}] _redeem_once() 進入，開始兌換流程 codes={codes}")
+    context = None
+    results = {}
 
     def log_entry(attempt, **kwargs):
         entry = {"redeem_retry": redeem_retry, "attempt": attempt}
@@ -445,110 +1424,60 @@ async def _redeem_once(player_id, code, debug_logs, redeem_retry, debug=False):
         debug_logs.append(entry)
 
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(
-                headless=True,
-                args=["--disable-gpu", "--no-sandbox", "--disable-dev-shm-usage"]
-            )
-            context = await browser.new_context(locale="zh-TW")
-            page = await context.new_page()
-
-            await page.goto("https://wos-giftcode.centurygame.com/", timeout=PAGE_LOAD_TIMEOUT)
-            await page.fill('input[placeholder="角色ID"]', player_id)
-            await page.click(".login_btn")
-
-            # 嘗試等待錯誤 modal
+        context, page = await PAGE_POOL.acquire()
+        await page.fill('input[placeholder="角色ID"]', player_id)
+        login = await _click_for_api_reply(page, ".login_btn", GIFTCODE_LOGIN_PATH)
+
+        if login is not None:
+            BROWSER_OUTCOME_SOURCES["login_api"] += 1
+            if login.get("code") != 0 or not login.get("data"):
+                message = giftcode_api_message(login, "player")
+                log_entry(0, error_modal=message, err_code=login.get("err_code"))
+                logger.info(f"[{player_id}] 登入失敗：{message}")
+                failure = await _package_result(
+                    page, False, f"登入失敗：{message}", player_id, debug_logs, debug=debug
+                )
+                return {code: dict(failure) for code in codes}
+        else:
+            # 備援：沒攔到 JSON 時照舊等待錯誤 modal
+            BROWSER_OUTCOME_SOURCES["login_modal"] += 1
             try:
                 await page.wait_for_selector(".message_modal", timeout=5000)
                 modal_text = await page.inner_text(".message_modal .msg")
                 log_entry(0, error_modal=modal_text)
                 if any(k in modal_text for k in FAILURE_KEYWORDS):
                     logger.info(f"[{player_id}] 登入失敗：{modal_text}")
-                    return await _package_result(
+                    failure = await _package_result(
                         page, False, f"登入失敗：{modal_text}", player_id, debug_logs, debug=debug
                     )
+                    return {code: dict(failure) for code in codes}
             except TimeoutError:
                 pass  # 無 modal 則繼續檢查登入成功
 
-            # 加強：等待 .name 與兌換欄位都出現才視為成功
-            try:
-                await page.wait_for_selector(".name", timeout=5000)
-                await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-            except TimeoutError:
-                return await _package_result(
-                    page, False,
-                    "登入失敗（未成功進入兌換頁） / Login failed (did not reach redeem page)",
-                    player_id, debug_logs, debug=debug
-                )
-
-            await page.fill('input[placeholder="請輸入兌換碼"]', code)
-
-            for attempt in range(1, OCR_MAX_RETRIES + 1):
-                try:
-                    logger.info(f"[{player_id}] CAPTCHA_API_KEY 存在檢查: {bool(CAPTCHA_API_KEY)}")
-                    captcha_text, method_used = await _solve_captcha(page, attempt, player_id)
-                    log_entry(attempt, captcha_text=captcha_text, method=method_used)
-
-                    await page.fill('input[placeholder="請輸入驗證碼"]', captcha_text or "")
-
-                    try:
-                        await page.click(".exchange_btn", timeout=3000)
-                        await page.wait_for_timeout(1000)
-
-                        for _ in range(10):
-                            modal = await page.query_selector(".message_modal")
-                            if modal:
-                                msg_el = await modal.query_selector("p.msg")
-                                if msg_el:
-                                    message = await msg_el.inner_text()
-                                    log_entry(attempt, server_message=message)
-                                    logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{message}")
-
-                                    confirm_btn = await modal.query_selector(".confirm_btn")
-                                    if confirm_btn and await confirm_btn.is_visible():
-                                        await confirm_btn.click()
-                                        await page.wait_for_timeout(500)
-
-                                    if "驗證碼錯誤" in message or "驗證碼已過期" in message:
-                                        await _refresh_captcha(page, player_id=player_id)
-                                        break
-
-                                    if any(k in message for k in FAILURE_KEYWORDS):
-                                        return await _package_result(
-                                            page, False, message, player_id, debug_logs, debug=debug
-                                        )
-
-                                    if "成功" in message:
-                                        return await _package_result(
-                                            page, True, message, player_id, debug_logs, debug=debug
-                                        )
-
-                                    return await _package_result(
-                                        page, False, f"未知錯誤：{message}", player_id, debug_logs, debug=debug
-                                    )
-
-                            await page.wait_for_timeout(300)
-                        else:
-                            log_entry(attempt, server_message="未出現 modal 回應（點擊被遮蔽或失敗）")
-                            await _refresh_captcha(page, player_id=player_id)
-                            continue
-
-                    except Exception as e:
-                        log_entry(attempt, error=f"點擊或等待 modal 時失敗: {str(e)}")
-                        await _refresh_captcha(page, player_id=player_id)
-                        await page.wait_for_timeout(1000)
-                        continue
+        # 加強：等待 .name 與兌換欄位都出現才視為成功
+        try:
+            await page.wait_for_selector(".name", timeout=5000)
+            await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
+        except TimeoutError:
+            failure = await _package_result(
+                page, False,
+                "登入失敗（未成功進入兌換頁） / Login failed (did not reach redeem page)",
+                player_id, debug_logs, debug=debug
+            )
+            return {code: dict(failure) for code in codes}
 
-                except Exception:
-                    log_entry(attempt, error=traceback.format_exc())
-                    await _refresh_captcha(page, player_id=player_id)
-                    await page.wait_for_timeout(1000)
+        if profile is not None:
+            try:
+                profile["name"], profile["kingdom"] = await _scrape_profile(page)
+            except Exception as e:
+                logger.warning(f"[{player_id}][Warn] 擷取名稱或王國失敗：{e}")
 
-            log_entry(attempt, info="驗證碼三次辨識皆失敗，放棄兌換")
-            logger.info(f"[{player_id}] 最終失敗：驗證碼三次辨識皆失敗 / Final failure: CAPTCHA failed 3 times")
-            return await _package_result(
-                page, False, "驗證碼三次辨識皆失敗，放棄兌換", player_id, debug_logs, debug=debug
+        # 同一次登入依序兌換每組兌換碼；第二組起先換一張新的驗證碼
+        for index, code in enumerate(codes):
+            results[code] = await _exchange_code(
+                page, player_id, code, log_entry, debug_logs, debug=debug, refresh=index > 0
             )
+        return results
 
     except Exception as e:
         logger.exception(f"[{player_id}] 發生例外錯誤：{e}")
@@ -570,10 +1499,11 @@ async def _redeem_once(player_id, code, debug_logs, redeem_retry, debug=False):
             "ECONNRESET",
             "EPIPE",
             "not connected",
+            "has been closed",
             "browserName=chromium"
         ])
 
-        return {
+        failure = {
             "player_id": player_id,
             "success": False,
             "reason": (f"_try browser launch failed: {err}") if transient else f"例外錯誤：{err}",
@@ -581,18 +1511,113 @@ async def _redeem_once(player_id, code, debug_logs, redeem_retry, debug=False):
             "debug_html_base64": base64.b64encode(html.encode("utf-8")).decode() if html else None,
             "debug_img_base64": base64.b64encode(img).decode() if img else None
         }
+        # 已完成的兌換碼保留結果，其餘以這次例外回報
+        return {code: results.get(code) or dict(failure) for code in codes}
 
     finally:
-        if browser:
-            await browser.close()
+        if context:
+            await PAGE_POOL.release(context)
 
     return {
-        "player_id": player_id,
-        "success": False,
-        "reason": "未知錯誤（流程未命中任何 return）",
-        "debug_logs": debug_logs
+        code: {
+            "player_id": player_id,
+            "success": False,
+            "reason": "未知錯誤（流程未命中任何 return）",
+            "debug_logs": debug_logs
+        }
+        for code in codes
     }
 
+async def _exchange_code(page, player_id, code, log_entry, debug_logs, debug=False, refresh=False):
+    """已登入的兌換頁：填兌換碼 → 驗證碼 → 兌換，最多 OCR_MAX_RETRIES 次，回傳單一兌換碼的結果"""
+    if refresh:
+        await _refresh_captcha(page, player_id=player_id)
+    await page.fill('input[placeholder="請輸入兌換碼"]', code)
+
+    for attempt in range(1, OCR_MAX_RETRIES + 1):
+        try:
+            logger.info(f"[{player_id}] CAPTCHA_API_KEY 存在檢查: {bool(CAPTCHA_API_KEY)}")
+            captcha_text, method_used = await _solve_captcha(page, attempt, player_id)
+            log_entry(attempt, code=code, captcha_text=captcha_text, method=method_used)
+
+            await page.fill('input[placeholder="請輸入驗證碼"]', captcha_text or "")
+
+            try:
+                reply = await _click_for_api_reply(page, ".exchange_btn", GIFTCODE_EXCHANGE_PATH, click_timeout=3000)
+                if reply is not None:
+                    BROWSER_OUTCOME_SOURCES["exchange_api"] += 1
+                    message = giftcode_api_message(reply, "gift_code")
+                    log_entry(attempt, code=code, server_message=message, err_code=reply.get("err_code"))
+                    logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{message}")
+                    await _dismiss_modal(page)
+                    CAPTCHA_BACKENDS.feedback(method_used, message)
+
+                    if giftcode_api_key(reply, "gift_code") in GIFTCODE_CAPTCHA_RETRY:
+                        await _refresh_captcha(page, player_id=player_id)
+                        continue
+                    return await _package_result(
+                        page, reply.get("err_code") == 20000, message, player_id, debug_logs, debug=debug
+                    )
+
+                # 備援：沒攔到 JSON 時照舊輪詢 modal 文字
+                BROWSER_OUTCOME_SOURCES["exchange_modal"] += 1
+                for _ in range(10):
+                    modal = await page.query_selector(".message_modal")
+                    if modal:
+                        msg_el = await modal.query_selector("p.msg")
+                        if msg_el:
+                            message = await msg_el.inner_text()
+                            log_entry(attempt, code=code, server_message=message)
+                            logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{message}")
+
+                            confirm_btn = await modal.query_selector(".confirm_btn")
+                            if confirm_btn and await confirm_btn.is_visible():
+                                await confirm_btn.click()
+                                await page.wait_for_timeout(500)
+
+                            CAPTCHA_BACKENDS.feedback(method_used, message)
+
+                            if "驗證碼錯誤" in message or "驗證碼已過期" in message:
+                                await _refresh_captcha(page, player_id=player_id)
+                                break
+
+                            if any(k in message for k in FAILURE_KEYWORDS):
+                                return await _package_result(
+                                    page, False, message, player_id, debug_logs, debug=debug
+                                )
+
+                            if "成功" in message:
+                                return await _package_result(
+                                    page, True, message, player_id, debug_logs, debug=debug
+                                )
+
+                            return await _package_result(
+                                page, False, f"未知錯誤：{message}", player_id, debug_logs, debug=debug
+                            )
+
+                    await page.wait_for_timeout(300)
+                else:
+                    log_entry(attempt, code=code, server_message="未出現 modal 回應（點擊被遮蔽或失敗）")
+                    await _refresh_captcha(page, player_id=player_id)
+                    continue
+
+            except Exception as e:
+                log_entry(attempt, code=code, error=f"點擊或等待 modal 時失敗: {str(e)}")
+                await _refresh_captcha(page, player_id=player_id)
+                await page.wait_for_timeout(1000)
+                continue
+
+        except Exception:
+            log_entry(attempt, code=code, error=traceback.format_exc())
+            await _refresh_captcha(page, player_id=player_id)
+            await page.wait_for_timeout(1000)
+
+    log_entry(attempt, code=code, info="驗證碼三次辨識皆失敗，放棄兌換")
+    logger.info(f"[{player_id}] 最終失敗：驗證碼三次辨識皆失敗 / Final failure: CAPTCHA failed 3 times")
+    return await _package_result(
+        page, False, "驗證碼三次辨識皆失敗，放棄兌換", player_id, debug_logs, debug=debug
+    )
+
 async def _solve_captcha(page, attempt, player_id):
     fallback_text = f"_try{attempt}"
     method_used = "none"
@@ -607,55 +1632,105 @@ async def _solve_captcha(page, attempt, player_id):
             logger.info(f"[{player_id}] 第 {attempt} 次：未找到驗證碼圖片")
             return fallback_text, method_used
 
-        await page.wait_for_timeout(500)
-        try:
-            captcha_bytes = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
-        except Exception as e:
-            logger.warning(f"[{player_id}] 第 {attempt} 次：captcha screenshot timeout 或錯誤 → {e}")
-            return fallback_text, method_used
+        captcha_bytes, source = await CAPTCHA_CAPTURE.grab(page, captcha_img, player_id, settle_ms=500)
 
-        # ✅ 圖片過小則自動刷新，避免 2Captcha 拒收
-        if not captcha_bytes or len(captcha_bytes) < 1024:
-            logger.warning(f"[{player_id}] 第 {attempt} 次：驗證碼圖太小（{len(captcha_bytes) if captcha_bytes else 0} bytes），自動刷新")
+        # ✅ 取不到圖（或截圖過小）則自動刷新，避免 2Captcha 拒收
+        if not captcha_bytes:
+            logger.warning(f"[{player_id}] 第 {attempt} 次：無法取得驗證碼圖片（{source}），自動刷新")
             await _refresh_captcha(page, player_id=player_id)
             return fallback_text, method_used
 
-        # 強化圖片 → base64 編碼
-        #b64_img = preprocess_image_for_2captcha(captcha_bytes)
-        b64_img = base64.b64encode(captcha_bytes).decode("utf-8")
-
-        logger.info(f"[{player_id}] 第 {attempt} 次：使用 2Captcha 辨識")
-        result = await solve_with_2captcha(b64_img)
+        logger.info(f"[{player_id}] 第 {attempt} 次：辨識驗證碼（{'/'.join(CAPTCHA_BACKEND_ORDER)}）")
+        result, backend = await CAPTCHA_BACKENDS.solve(captcha_bytes, player_id=player_id)
         if result == "UNSOLVABLE":
-            logger.warning(f"[{player_id}] 第 {attempt} 次：2Captcha 回傳無解 → 自動刷新圖")
-            log_entry(attempt, info="2Captcha 回傳 UNSOLVABLE")
+            logger.warning(f"[{player_id}] 第 {attempt} 次：{backend} 回傳無解 → 自動刷新圖")
+            log_entry(attempt, info=f"{backend} 回傳 UNSOLVABLE")
             await _refresh_captcha(page, player_id=player_id)
             return fallback_text, method_used
 
         if result:
-            result = result.strip()
-            if len(result) == 4 and result.isalnum():
-                method_used = "2captcha"
-                logger.info(f"[{player_id}] 第 {attempt} 次：2Captcha 成功辨識 → {result}")
-                return result, method_used
-            else:
-                logger.warning(f"[{player_id}] 第 {attempt} 次：2Captcha 回傳長度不符（{len(result)}字 → {result}），強制刷新")
-                await _refresh_captcha(page, player_id=player_id)
-                return fallback_text, method_used
+            logger.info(f"[{player_id}] 第 {attempt} 次：{backend} 成功辨識 → {result}")
+            return result, backend
+
+        logger.warning(f"[{player_id}] 第 {attempt} 次：所有辨識後端皆無可用結果，強制刷新")
+        await _refresh_captcha(page, player_id=player_id)
+        return fallback_text, method_used
 
     except Exception as e:
         logger.exception(f"[{player_id}] 第 {attempt} 次：例外錯誤：{e}")
         return fallback_text, method_used
 
-# def preprocess_image_for_2captcha(img_bytes, scale=2.5):
-#     """轉灰階、二值化、放大並轉 base64 編碼"""
-#     img = Image.open(BytesIO(img_bytes)).convert("L")  # 灰階
-#     img = img.point(lambda x: 0 if x < 140 else 255, '1')  # 二值化
-#     new_size = (int(img.width * scale), int(img.height * scale))
-#     img = img.resize(new_size, Image.LANCZOS)
-#     buffer = BytesIO()
-#     img.save(buffer, format="PNG")
-#     return base64.b64encode(buffer.getvalue()).decode("utf-8")
+# === 驗證碼上傳前處理（需 Pillow）：裁掉空白邊、灰階、二值化後以最小的 PNG 重新編碼 ===
+CAPTCHA_PREPROCESS = [s.strip() for s in os.getenv("CAPTCHA_PREPROCESS", "").split(",") if s.strip()]  # 例：crop,gray,binarize
+CAPTCHA_PREPROCESS_RATIO = float(os.getenv("CAPTCHA_PREPROCESS_RATIO", "1"))  # 0~1，部分套用以便比較前處理前後的表現
+CAPTCHA_BINARIZE_THRESHOLD = int(os.getenv("CAPTCHA_BINARIZE_THRESHOLD", "140"))
+CAPTCHA_CROP_TOLERANCE = 24  # 與背景色差超過此值才算內容
+
+def preprocess_image_for_2captcha(img_bytes, steps=None):
+    """依 steps（crop / gray / binarize）處理後回傳 PNG bytes；比原圖大時回傳原圖"""
+    steps = CAPTCHA_PREPROCESS if steps is None else steps
+    img = Image.open(BytesIO(img_bytes))
+    img.load()
+    if "crop" in steps:
+        rgb = img.convert("RGB")
+        background = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+        diff = ImageChops.difference(rgb, background).convert("L")
+        bbox = diff.point(lambda x: 255 if x > CAPTCHA_CROP_TOLERANCE else 0).getbbox()
+        if bbox:
+            pad = 2
+            img = img.crop((max(0, bbox[0] - pad), max(0, bbox[1] - pad),
+                            min(img.width, bbox[2] + pad), min(img.height, bbox[3] + pad)))
+    if "gray" in steps or "binarize" in steps:
+        img = ImageOps.grayscale(img)
+    if "binarize" in steps:
+        img = img.point(lambda x: 0 if x < CAPTCHA_BINARIZE_THRESHOLD else 255, "1")
+    buffer = BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    out = buffer.getvalue()
+    return out if len(out) < len(img_bytes) else img_bytes
+
+class CaptchaPreprocessor:
+    """套用 preprocess_image_for_2captcha 並統計處理前後大小與耗時"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def enabled(self):
+        return Image is not None and bool(CAPTCHA_PREPROCESS)
+
+    def should_apply(self):
+        return self.enabled() and random.random() < CAPTCHA_PREPROCESS_RATIO
+
+    def process(self, img_bytes):
+        started = time.monotonic()
+        try:
+            out = preprocess_image_for_2captcha(img_bytes)
+        except Exception as e:
+            logger.warning(f"[CaptchaPre] 前處理失敗，改用原圖：{e!r}")
+            with self._lock:
+                self._stats["errors"] += 1
+            return img_bytes
+        with self._lock:
+            self._stats.update(
+                images=1,
+                bytes_in=len(img_bytes),
+                bytes_out=len(out),
+                total_ms=int((time.monotonic() - started) * 1000),
+            )
+        return out
+
+    def stats(self):
+        with self._lock:
+            c = self._stats
+            return {
+                "enabled": self.enabled(),
+                "steps": CAPTCHA_PREPROCESS,
+                **dict(c),
+                "size_ratio": round(c["bytes_out"] / c["bytes_in"], 3) if c["bytes_in"] else None,
+            }
+
+CAPTCHA_PREPROCESSOR = CaptchaPreprocessor()
 
 def _clean_ocr_text(text):
     """替換常見誤判字元並移除非字母數字"""
@@ -683,69 +1758,381 @@ def _clean_ocr_text(text):
 #     )
 
 CAPTCHA_API_KEY = os.getenv("CAPTCHA_API_KEY")
+CAPTCHA_API_BASE = os.getenv("CAPTCHA_API_BASE", "http://2captcha.com").rstrip("/")
 logger.info(f"CAPTCHA_API_KEY 設定檢查: {bool(CAPTCHA_API_KEY)}")
 
-async def solve_with_2captcha(b64_img):
-    api_key = os.getenv("CAPTCHA_API_KEY")
-    if not api_key:
-        logger.warning("[2Captcha] CAPTCHA_API_KEY 未設定，跳過遠端解碼")
-        return None
-    payload = {
-        "key": api_key,
-        "method": "base64",
-        "body": b64_img,
-        "json": 1,
-        "numeric": 0,
-        "min_len": 4,
-        "max_len": 5,
-        "language": 2
-    }
+# === 2Captcha 共用客戶端：常駐於 captcha-loop，單一連線池 + 單一輪詢迴圈 ===
+CAPTCHA_FIRST_POLL_DELAY = float(os.getenv("CAPTCHA_FIRST_POLL_DELAY", "5"))  # 秒，提交後多久開始查詢
+CAPTCHA_POLL_INTERVAL = float(os.getenv("CAPTCHA_POLL_INTERVAL", "5"))        # 秒，兩次批次查詢的間隔
+CAPTCHA_SOLVE_TIMEOUT = float(os.getenv("CAPTCHA_SOLVE_TIMEOUT", "65"))       # 秒，約等於原本 12 次 × 5 秒
+CAPTCHA_POLL_BATCH = 100  # res.php?action=get&ids= 單次查詢的 ID 上限
+
+class TwoCaptchaClient:
+    """所有兌換共用的 2Captcha 客戶端：提交各自進行，結果由一條輪詢迴圈以 ids= 一次查完所有未完成的任務。
+    aiohttp session 綁定事件迴圈，因此整個客戶端跑在自己的背景迴圈上，呼叫端從任何迴圈 await 皆可"""
+
+    def __init__(self):
+        self.runner = BackgroundLoop("captcha-loop")
+        self._session = None
+        self._waiting = {}  # request_id -> (future, 最早可查詢時間)
+        self._poller = None
+        self.submitted = 0
+        self.solved = 0
+        self.unsolvable = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.polls = 0
+
+    async def solve(self, b64_img):
+        return await self.runner.run(self._solve(b64_img))
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            )
+        return self._session
+
+    async def _solve(self, b64_img):
+        api_key = os.getenv("CAPTCHA_API_KEY")
+        if not api_key:
+            logger.warning("[2Captcha] CAPTCHA_API_KEY 未設定，跳過遠端解碼")
+            return None
+        payload = {
+            "key": api_key,
+            "method": "base64",
+            "body": b64_img,
+            "json": 1,
+            "numeric": 0,
+            "min_len": 4,
+            "max_len": 5,
+            "language": 2
+        }
 
-    async with aiohttp.ClientSession() as session:
         try:
             logger.info(f"[2Captcha] 提交開始，圖片大小：{len(b64_img)} bytes")
-            async with session.post("http://2captcha.com/in.php", data=payload) as resp:
+            async with self._get_session().post(f"{CAPTCHA_API_BASE}/in.php", data=payload) as resp:
                 if resp.content_type != "application/json":
                     text = await resp.text()
                     logger.error(f"2Captcha 提交回傳非 JSON（{resp.status}）：{text}")
+                    self.errors += 1
                     return None
 
                 res = await resp.json()
                 if res.get("status") != 1:
                     logger.warning(f"2Captcha 提交失敗：{res}")
+                    self.errors += 1
                     return None
 
-                request_id = res["request"]
+                request_id = str(res["request"])
         except Exception as e:
             logger.exception(f"提交 2Captcha 發生錯誤：{e}")
+            self.errors += 1
             return None
 
-        # 等待辨識結果
-        for _ in range(12):
-            await asyncio.sleep(5)
-            try:
-                logger.info(f"[2Captcha] 查詢結果中，ID={request_id}")
-                async with session.get(f"http://2captcha.com/res.php?key={api_key}&action=get&id={request_id}&json=1") as resp:
-                    if resp.content_type != "application/json":
-                        text = await resp.text()
-                        logger.error(f"2Captcha 查詢回傳非 JSON（{resp.status}）：{text}")
-                        return None
-
-                    result = await resp.json()
-                    if result.get("status") == 1:
-                        return result.get("request")
-                    if result.get("request") == "ERROR_CAPTCHA_UNSOLVABLE":
-                        logger.warning(f"2Captcha 回傳無法解碼錯誤 → {result}")
-                        return "UNSOLVABLE"
-                    elif result.get("request") != "CAPCHA_NOT_READY":
-                        logger.warning(f"2Captcha 回傳錯誤結果：{result}")
-                        return None
+        self.submitted += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiting[request_id] = (future, loop.time() + CAPTCHA_FIRST_POLL_DELAY)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll_loop())
+        try:
+            return await asyncio.wait_for(future, CAPTCHA_SOLVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"[2Captcha] 等待結果逾時，ID={request_id}")
+            self.timeouts += 1
+            return None
+        finally:
+            self._waiting.pop(request_id, None)
+
+    async def _poll_loop(self):
+        loop = asyncio.get_running_loop()
+        while self._waiting:
+            now = loop.time()
+            due = [rid for rid, (future, ready_at) in self._waiting.items() if ready_at <= now and not future.done()]
+            if not due:
+                next_ready = min(ready_at for _, ready_at in self._waiting.values())
+                await asyncio.sleep(max(0.05, next_ready - now))
+                continue
+            for i in range(0, len(due), CAPTCHA_POLL_BATCH):
+                await self._poll(due[i:i + CAPTCHA_POLL_BATCH])
+            await asyncio.sleep(CAPTCHA_POLL_INTERVAL)
+
+    def _resolve(self, request_id, answer):
+        future = self._waiting.get(request_id, (None, None))[0]
+        if future and not future.done():
+            future.set_result(answer)
+
+    async def _poll(self, request_ids):
+        api_key = os.getenv("CAPTCHA_API_KEY")
+        self.polls += 1
+        try:
+            logger.info(f"[2Captcha] 批次查詢結果中，共 {len(request_ids)} 筆")
+            params = {"key": api_key, "action": "get", "ids": ",".join(request_ids), "json": 1}
+            async with self._get_session().get(f"{CAPTCHA_API_BASE}/res.php", params=params) as resp:
+                if resp.content_type != "application/json":
+                    text = await resp.text()
+                    logger.error(f"2Captcha 查詢回傳非 JSON（{resp.status}）：{text}")
+                    return
+                result = await resp.json()
+        except Exception as e:
+            logger.warning(f"查詢 2Captcha 結果發生錯誤（下一輪再查）：{e!r}")
+            return
+
+        answers = str(result.get("request") or "").split("|")
+        if len(answers) != len(request_ids):
+            # 整批錯誤（例如 key 無效）或全部尚未完成時只會回一個值
+            if answers == ["CAPCHA_NOT_READY"]:
+                return
+            logger.warning(f"2Captcha 回傳錯誤結果：{result}")
+            self.errors += len(request_ids)
+            for request_id in request_ids:
+                self._resolve(request_id, None)
+            return
 
+        for request_id, answer in zip(request_ids, answers):
+            if answer == "CAPCHA_NOT_READY":
+                continue
+            if answer == "ERROR_CAPTCHA_UNSOLVABLE":
+                logger.warning(f"2Captcha 回傳無法解碼錯誤 → ID={request_id}")
+                self.unsolvable += 1
+                self._resolve(request_id, "UNSOLVABLE")
+            elif answer.startswith("ERROR"):
+                logger.warning(f"2Captcha 回傳錯誤結果：ID={request_id} {answer}")
+                self.errors += 1
+                self._resolve(request_id, None)
+            else:
+                self.solved += 1
+                self._resolve(request_id, answer)
+
+    def stats(self):
+        return {
+            "waiting": len(self._waiting),
+            "submitted": self.submitted,
+            "solved": self.solved,
+            "unsolvable": self.unsolvable,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "polls": self.polls,
+        }
+
+CAPTCHA_SOLVER = TwoCaptchaClient()
+
+async def solve_with_2captcha(b64_img):
+    return await CAPTCHA_SOLVER.solve(b64_img)
+
+# === 驗證碼辨識後端：依 CAPTCHA_BACKENDS 順序嘗試，本機辨識信心不足才交給 2Captcha ===
+CAPTCHA_BACKEND_ORDER = [b.strip() for b in os.getenv("CAPTCHA_BACKENDS", "local,2captcha").split(",") if b.strip()]
+LOCAL_OCR_MIN_CONFIDENCE = float(os.getenv("LOCAL_OCR_MIN_CONFIDENCE", "0.85"))  # 每個字元的最低機率
+
+LOCAL_OCR_CHARSET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def is_valid_captcha_text(text):
+    # str.isalnum() 對中日韓文字也成立，需另外限定 ASCII
+    return bool(text) and len(text) == 4 and text.isascii() and text.isalnum()
+
+class LocalOcrBackend:
+    """ddddocr（ONNX，CPU）辨識 .verify_pic；回傳每個字元機率的最小值作為信心"""
+    name = "local"
+
+    def __init__(self):
+        self._ocr = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        return ddddocr is not None
+
+    def _classify(self, img_bytes):
+        with self._lock:
+            if self._ocr is None:
+                self._ocr = ddddocr.DdddOcr(show_ad=False)
+                # 預設字元集含數千個中文字；驗證碼只有英數，限定後機率也只在英數之間比較。
+                # 直接給字元字串：數字代碼在 1.6 版之後的意義不同
+                self._ocr.set_ranges(LOCAL_OCR_CHARSET)
+            result = self._ocr.classification(img_bytes, probability=True)
+        if "charsets" not in result:
+            # 1.6 版起的輸出格式：{"text", "probabilities", "charset", "confidence"}
+            return result.get("text") or "", float(result.get("confidence") or 0.0)
+        charsets = result["charsets"]
+        # CTC greedy decode：逐步取最大機率，略過空白並合併連續重複
+        text, confidence, previous = "", 1.0, None
+        for probs in result["probability"]:
+            best = max(range(len(probs)), key=probs.__getitem__)
+            if best != previous and charsets[best]:
+                text += charsets[best]
+                confidence = min(confidence, probs[best])
+            previous = best
+        return text, (confidence if text else 0.0)
+
+    async def solve(self, img_bytes):
+        text, confidence = await run_in_executor(functools.partial(self._classify, img_bytes))
+        if not is_valid_captcha_text(text) or confidence < LOCAL_OCR_MIN_CONFIDENCE:
+            logger.info(f"[LocalOCR] 信心不足或格式不符：{text!r} confidence={confidence:.2f}")
+            return None, self.name
+        return text, self.name
+
+class TwoCaptchaBackend:
+    name = "2captcha"
+
+    def available(self):
+        return bool(os.getenv("CAPTCHA_API_KEY"))
+
+    async def solve(self, img_bytes):
+        # 有前處理的結果另記為 2captcha+pre，可在 /metrics 比較兩者的延遲與正確率
+        label = self.name
+        if CAPTCHA_PREPROCESSOR.should_apply():
+            img_bytes = await run_in_executor(functools.partial(CAPTCHA_PREPROCESSOR.process, img_bytes))
+            label = f"{self.name}+pre"
+        result = await solve_with_2captcha(base64.b64encode(img_bytes).decode("utf-8"))
+        if result == "UNSOLVABLE":
+            return result, label
+        result = (result or "").strip()
+        if not is_valid_captcha_text(result):
+            if result:
+                logger.warning(f"[2Captcha] 回傳長度不符（{len(result)}字 → {result}）")
+            return None, label
+        return result, label
+
+class CaptchaBackends:
+    """依序嘗試各後端，並統計每個後端的回答率、延遲與（依兌換回覆得知的）正確率"""
+
+    def __init__(self, backends, order):
+        by_name = {b.name: b for b in backends}
+        self.backends = [by_name[n] for n in order if n in by_name]
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(collections.Counter)
+
+    def _count(self, name, **deltas):
+        with self._lock:
+            self._stats[name].update(deltas)
+
+    async def solve(self, img_bytes, player_id=None):
+        """回傳（答案, 後端名稱）；2Captcha 判定無解時答案為 "UNSOLVABLE"，全部失敗為（None, "none"）"""
+        for backend in self.backends:
+            if not backend.available():
+                continue
+            started = time.monotonic()
+            try:
+                result, label = await backend.solve(img_bytes)
             except Exception as e:
-                logger.exception(f"查詢 2Captcha 結果發生錯誤：{e}")
-                return None
+                logger.warning(f"[{player_id}] 驗證碼後端 {backend.name} 發生錯誤：{e!r}")
+                result, label = None, backend.name
+            elapsed_ms = int((time.monotonic() - started) * 1000)
+            self._count(label, attempts=1, latency_ms=elapsed_ms,
+                        answered=1 if is_valid_captcha_text(result) else 0,
+                        unsolvable=1 if result == "UNSOLVABLE" else 0)
+            if result == "UNSOLVABLE":
+                return result, label
+            if result:
+                logger.info(f"[{player_id}] 驗證碼由 {label} 辨識 → {result}（{elapsed_ms}ms）")
+                return result, label
+        return None, "none"
+
+    def feedback(self, name, message):
+        """依兌換回覆記錄正確率：驗證碼錯誤算答錯；驗證碼過期與節流無法判斷；其餘回覆代表驗證碼已通過"""
+        with self._lock:
+            if name not in self._stats:
+                return
+        if "驗證碼錯誤" in message:
+            self._count(name, wrong=1)
+        elif "驗證碼已過期" not in message and not any(k in message for k in THROTTLE_KEYWORDS):
+            self._count(name, correct=1)
+
+    def stats(self):
+        with self._lock:
+            out = {}
+            for name, c in self._stats.items():
+                judged = c["correct"] + c["wrong"]
+                out[name] = {
+                    **dict(c),
+                    "avg_latency_ms": round(c["latency_ms"] / c["attempts"]) if c["attempts"] else None,
+                    "accuracy": round(c["correct"] / judged, 3) if judged else None,
+                }
+            return out
 
-    return None
+CAPTCHA_BACKENDS = CaptchaBackends([LocalOcrBackend(), TwoCaptchaBackend()], CAPTCHA_BACKEND_ORDER)
+
+# === 驗證碼原圖擷取：優先讀 <img> 的 data URL 或 /api/captcha 回應，截圖只作備援 ===
+CAPTCHA_API_PATH = "/api/captcha"
+CAPTCHA_MIN_SCREENSHOT_BYTES = 1024  # 截圖小於此值多半是圖片尚未載入
+CAPTCHA_REFRESH_TIMEOUT = int(os.getenv("CAPTCHA_REFRESH_TIMEOUT", "8000"))  # 毫秒，點刷新到新圖出現的上限
+
+def decode_data_url(src):
+    """data:image/...;base64,xxx → bytes；不是 base64 data URL 時回傳 None"""
+    if not src or not src.startswith("data:image/") or ";base64," not in src:
+        return None
+    try:
+        return base64.b64decode(src.split(",", 1)[1])
+    except Exception:
+        return None
+
+class CaptchaCapture:
+    """每個頁面記下最近一次 /api/captcha 回應的圖片，並統計各擷取方式的使用次數"""
+
+    def __init__(self):
+        self._latest = weakref.WeakKeyDictionary()  # page -> 最近一次回應的圖片 bytes
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def attach(self, page):
+        """在頁面開啟時掛上回應監聽；只看驗證碼 API，不影響其他請求"""
+        page.on("response", lambda response: asyncio.ensure_future(self._on_response(page, response)))
+
+    async def _on_response(self, page, response):
+        if CAPTCHA_API_PATH not in response.url:
+            return
+        try:
+            reply = await response.json()
+            img = decode_data_url(((reply.get("data") or {}).get("img") or ""))
+        except Exception:
+            return
+        if img:
+            self._latest[page] = img
+
+    def _count(self, source, size=0):
+        with self._lock:
+            self._stats[source] += 1
+            if size:
+                self._stats[f"{source}_bytes"] += size
+
+    async def grab(self, page, captcha_img, player_id=None, settle_ms=0):
+        """回傳 (bytes, 來源)；來源為 src / network / screenshot，全部失敗時 bytes 為 None。
+        settle_ms：要走截圖備援時，先等圖片畫完再截（只截一次）"""
+        try:
+            src = await captcha_img.get_attribute("src")
+        except Exception:
+            src = None
+        img = decode_data_url(src)
+        if img:
+            self._count("src", len(img))
+            return img, "src"
+
+        img = self._latest.get(page)
+        if img:
+            self._count("network", len(img))
+            return img, "network"
+
+        if settle_ms:
+            await page.wait_for_timeout(settle_ms)
+        try:
+            img = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
+        except Exception as e:
+            logger.warning(f"[{player_id}] captcha screenshot timeout 或錯誤 → {e} / captcha screenshot timeout or error")
+            self._count("failed")
+            return None, "screenshot"
+        if not img or len(img) < CAPTCHA_MIN_SCREENSHOT_BYTES:
+            # 圖片還沒畫出來：當作擷取失敗，交給呼叫端刷新
+            self._count("screenshot_too_small")
+            return None, "screenshot"
+        self._count("screenshot", len(img))
+        return img, "screenshot"
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+CAPTCHA_CAPTURE = CaptchaCapture()
 
 async def _refresh_captcha(page, player_id=None):
     try:
@@ -765,56 +2152,74 @@ async def _refresh_captcha(page, player_id=None):
                 await confirm_btn.click()
             await page.wait_for_timeout(1000)
 
+        original_src = await captcha_img.get_attribute("src") or ""
+
+        # 點擊刷新按鈕，等待 /api/captcha 的回應（伺服器多快回就多快結束）
+        started = time.monotonic()
         try:
-            original_bytes = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
+            async with page.expect_response(
+                lambda r: CAPTCHA_API_PATH in r.url, timeout=CAPTCHA_REFRESH_TIMEOUT
+            ) as response_info:
+                await refresh_btn.click()
+            reply = await (await response_info.value).json()
         except Exception as e:
-            logger.warning(f"[{player_id}] captcha 原圖 screenshot timeout 或錯誤 → {e} / original captcha screenshot timeout or error")
+            logger.info(f"[{player_id}] 刷新失敗：等不到驗證碼回應 → {e} / Refresh failed: no captcha response")
             return
-        original_hash = hashlib.md5(original_bytes).hexdigest() if original_bytes else ""
-
-        # 點擊刷新按鈕
-        await refresh_btn.click()
-        await page.wait_for_timeout(1500)
 
-        # 處理 modal（如果彈出錯誤訊息）
-        for _ in range(8):
-            modal = await page.query_selector('.message_modal')
-            if modal:
-                msg_el = await modal.query_selector('p.msg')
-                if msg_el:
-                    msg_text = await msg_el.inner_text()
-                    logger.info(f"[{player_id}] Captcha Modal：{msg_text.strip()}")
-                    if any(k in msg_text for k in ["過於頻繁", "伺服器繁忙", "請稍後再試"]):
-                        confirm_btn = await modal.query_selector('.confirm_btn')
-                        if confirm_btn:
-                            await confirm_btn.click()
-                        await page.wait_for_timeout(1500)
-                        return
-            await page.wait_for_timeout(300)
-
-        # 等待圖刷新
-        for i in range(30):
-            await page.wait_for_timeout(150)
-            try:
-                new_bytes = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
-            except Exception as e:
-                logger.warning(f"[{player_id}] captcha 新圖 screenshot timeout 或錯誤（第 {i+1} 次）→ {e}")
-                continue
+        if not ((reply.get("data") or {}).get("img")):
+            # 伺服器拒絕發新圖（多半是過於頻繁）：關掉提示並通知限速器
+            message = giftcode_api_message(reply, "captcha")
+            logger.info(f"[{player_id}] Captcha 回應：{message}")
+            if any(k in message for k in THROTTLE_KEYWORDS):
+                RATE_CONTROLLER.on_throttle("captcha")
+            await _dismiss_modal(page)
+            return
 
-            if not new_bytes or len(new_bytes) < 1024:
-                continue
-            new_hash = hashlib.md5(new_bytes).hexdigest()
-            if new_hash != original_hash:
-                box = await captcha_img.bounding_box()
-                if box and box["height"] > 10:
-                    logger.info(f"[{player_id}] 成功刷新驗證碼 (hash 第 {i+1} 次變化)")
-                    return
-        else:
+        # 新圖已到，等前端把 src 換掉（與回應共用同一個逾時）
+        remaining = max(0, CAPTCHA_REFRESH_TIMEOUT - int((time.monotonic() - started) * 1000))
+        try:
+            await page.wait_for_function(
+                "([sel, old]) => { const el = document.querySelector(sel); return el && el.src && el.src !== old; }",
+                arg=[".verify_pic", original_src],
+                timeout=max(remaining, 500),
+            )
+        except Exception:
             logger.info(f"[{player_id}] 刷新失敗：圖片內容未更新 / Refresh failed: Captcha image did not update")
+            return
+        logger.info(f"[{player_id}] 成功刷新驗證碼（{int((time.monotonic() - started) * 1000)} ms）")
 
     except Exception as e:
         logger.info(f"[{player_id}] Captcha 刷新例外：{str(e)} / Refresh captcha exception: {str(e)}")
 
+# === 瀏覽器引擎：直接讀登入 / 兌換 API 的 JSON 回應，modal 文字只作備援 ===
+GIFTCODE_LOGIN_PATH = "/api/player"
+GIFTCODE_EXCHANGE_PATH = "/api/gift_code"
+GIFTCODE_RESPONSE_TIMEOUT = int(os.getenv("GIFTCODE_RESPONSE_TIMEOUT", "10000"))  # 毫秒
+GIFTCODE_CAPTCHA_RETRY = {"CAPTCHA CHECK ERROR", "CAPTCHA EXPIRED"}
+BROWSER_OUTCOME_SOURCES = collections.Counter()  # api / modal：各流程靠哪種方式判定結果
+
+async def _click_for_api_reply(page, selector, path, click_timeout=None):
+    """點擊按鈕並等待對應 API 的 JSON 回應；點擊本身失敗會拋出，等不到回應時回傳 None"""
+    clicked = False
+    try:
+        async with page.expect_response(
+            lambda r: path in r.url and r.request.method == "POST", timeout=GIFTCODE_RESPONSE_TIMEOUT
+        ) as response_info:
+            await page.click(selector, timeout=click_timeout)
+            clicked = True
+        return await (await response_info.value).json()
+    except Exception as e:
+        if not clicked:
+            raise
+        logger.info(f"未攔到 {path} 回應，改讀 modal → {e} / No {path} response captured, falling back to modal")
+        return None
+
+async def _dismiss_modal(page, timeout=2000):
+    """按掉 API 回應後跳出的提示框，避免擋住下一步操作"""
+    with contextlib.suppress(Exception):
+        confirm_btn = await page.wait_for_selector(".message_modal .confirm_btn", timeout=timeout)
+        await confirm_btn.click()
+
 async def _package_result(page, success, message, player_id, debug_logs, debug=False):
     result = {
         "player_id": player_id,
@@ -837,107 +2242,697 @@ async def _package_result(page, success, message, player_id, debug_logs, debug=F
     result["reason"] = result.get("reason") or "未知錯誤"
     return result
 
-# === 共用函式：透過 Playwright 取得玩家名稱與王國 ===
-async def fetch_name_and_kingdom_common(pid):
-    logger.info(f"[{pid}] Playwright 啟動準備")
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            args=["--disable-gpu", "--no-sandbox", "--disable-dev-shm-usage"]
-        )
-        try:
-            context = await browser.new_context(locale="zh-TW")
-            page = await context.new_page()
+# === HTTP 兌換引擎：直接呼叫禮包碼網站背後的 JSON API，不開瀏覽器 ===
+WOS_API_BASE = os.getenv("WOS_API_BASE", "https://wos-giftcode-api.centurygame.com/api").rstrip("/")
+WOS_API_SECRET = os.getenv("WOS_API_SECRET", "tB87#kPtkxqOS2")
+REDEEM_ENGINES = ("browser", "http")
+DEFAULT_REDEEM_ENGINE = os.getenv("REDEEM_ENGINE", "browser")
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "32"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "15"))  # 秒
+
+# 伺服器 msg / err_code → 與網頁 modal 相同的中文訊息，讓 is_success_reason 與 RETRY_KEYWORDS 照常判斷
+GIFTCODE_API_MESSAGES = {
+    "SUCCESS": "兌換成功，請在信件中領取獎勵！",
+    "RECEIVED": "您已領取過該禮包",
+    "SAME TYPE EXCHANGE": "已兌換過同類型禮包",
+    "TIME ERROR": "超出兌換時間",
+    "CDK NOT FOUND": "兌換碼不存在",
+    "USED": "兌換碼可兌換次數已達上限",  # 避開 SUCCESS_KEYWORDS 的「已使用」
+    "TIMEOUT RETRY": "伺服器繁忙，請稍後再試",
+    "CAPTCHA CHECK ERROR": "驗證碼錯誤",
+    "CAPTCHA EXPIRED": "驗證碼已過期",
+    "CAPTCHA CHECK TOO FREQUENT": "驗證過於頻繁，請稍後再試",
+    "CAPTCHA GET TOO FREQUENT": "驗證碼取得過於頻繁，請稍後再試",
+    "NOT LOGIN": "請先登入",
+    "ROLE NOT EXIST": "角色不存在",
+}
+# err_code 依端點而異：同一個 40004 在 player 是「角色不存在」，在 gift_code 是「伺服器繁忙」
+GIFTCODE_API_ERR_CODES = {
+    "player": {
+        40004: "ROLE NOT EXIST",
+    },
+    "captcha": {
+        40100: "CAPTCHA GET TOO FREQUENT",
+    },
+    "gift_code": {
+        20000: "SUCCESS",
+        40008: "RECEIVED",
+        40011: "SAME TYPE EXCHANGE",
+        40007: "TIME ERROR",
+        40014: "CDK NOT FOUND",
+        40005: "USED",
+        40004: "TIMEOUT RETRY",
+        40103: "CAPTCHA CHECK ERROR",
+        40102: "CAPTCHA EXPIRED",
+        40101: "CAPTCHA CHECK TOO FREQUENT",
+    },
+}
+
+def resolve_engine(engine):
+    engine = (engine or DEFAULT_REDEEM_ENGINE or "browser").lower()
+    return engine if engine in REDEEM_ENGINES else "browser"
+
+def giftcode_api_key(reply, endpoint):
+    """API 回應對應到 GIFTCODE_API_MESSAGES 的鍵（例：CAPTCHA CHECK ERROR）；
+    先看該端點的 err_code，對不到才比對 msg 文字，都無法辨識時回傳 None"""
+    try:
+        key = GIFTCODE_API_ERR_CODES.get(endpoint, {}).get(int(reply.get("err_code")))
+    except (TypeError, ValueError):
+        key = None
+    if key:
+        return key
+    msg = str(reply.get("msg") or "").strip().rstrip(".").upper()
+    return msg if msg in GIFTCODE_API_MESSAGES else None
+
+def giftcode_api_message(reply, endpoint):
+    """把 API 回應轉成中文訊息；未知的回應原樣保留以便除錯"""
+    key = giftcode_api_key(reply, endpoint)
+    if key:
+        return GIFTCODE_API_MESSAGES[key]
+    return f"未知回應：{reply.get('msg')}（err_code={reply.get('err_code')}）"
+
+def _giftcode_sign(params):
+    raw = "&".join(f"{k}={params[k]}" for k in sorted(params))
+    return hashlib.md5((raw + WOS_API_SECRET).encode("utf-8")).hexdigest()
+
+# aiohttp 的連線池綁定事件迴圈，每條迴圈各保留一個共用 connector
+_HTTP_CONNECTORS = weakref.WeakKeyDictionary()
+
+def _http_connector():
+    loop = asyncio.get_running_loop()
+    connector = _HTTP_CONNECTORS.get(loop)
+    if connector is None or connector.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, ttl_dns_cache=300)
+        _HTTP_CONNECTORS[loop] = connector
+    return connector
+
+async def close_http_connector():
+    connector = _HTTP_CONNECTORS.pop(asyncio.get_running_loop(), None)
+    if connector and not connector.closed:
+        await connector.close()
+
+def giftcode_session():
+    """逐玩家獨立 cookie，但共用同一個連線池"""
+    return aiohttp.ClientSession(
+        connector=_http_connector(),
+        connector_owner=False,
+        cookie_jar=aiohttp.CookieJar(unsafe=True),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+    )
 
-            name, kingdom = "未知名稱", None
+async def giftcode_api_call(session, endpoint, params):
+    params = {**params, "time": int(time.time() * 1000)}
+    params["sign"] = _giftcode_sign(params)
+    async with session.post(f"{WOS_API_BASE}/{endpoint}", data=params) as resp:
+        return await resp.json(content_type=None)
 
-            for attempt in range(3):
-                try:
-                    await page.goto("https://wos-giftcode.centurygame.com/", timeout=PAGE_LOAD_TIMEOUT)
+async def _redeem_once_http(player_id, codes, debug_logs, redeem_retry, debug=False, profile=None):
+    """與 _redeem_once 相同的 登入 → 驗證碼 → 兌換 流程與回傳格式（{code: result}），但只走 HTTP"""
+    logger.info(f"[{player_id}] _redeem_once_http() 進入，開始兌換流程 codes={codes}")
+    results = {}
 
-                    # 角色ID欄位：中文優先、英文備援
-                    try:
-                        await page.wait_for_selector('input[placeholder="角色ID"]:visible', timeout=5000)
-                        await page.fill('input[placeholder="角色ID"]', pid)
-                    except Exception:
-                        await page.wait_for_selector('input[placeholder="Character ID"]:visible', timeout=5000)
-                        await page.fill('input[placeholder="Character ID"]', pid)
+    def log_entry(attempt, **kwargs):
+        entry = {"redeem_retry": redeem_retry, "attempt": attempt, "engine": "http"}
+        entry.update(kwargs)
+        debug_logs.append(entry)
 
-                    await page.click(".login_btn")
+    try:
+        async with giftcode_session() as session:
+            login = await giftcode_api_call(session, "player", {"fid": player_id})
+            if login.get("code") != 0 or not login.get("data"):
+                message = giftcode_api_message(login, "player")
+                log_entry(0, error_modal=message)
+                logger.info(f"[{player_id}] 登入失敗：{message}")
+                failure = await _package_result(None, False, f"登入失敗：{message}", player_id, debug_logs)
+                return {code: dict(failure) for code in codes}
+
+            if profile is not None:
+                player = login["data"]
+                profile["name"] = re.sub(r"\s+", " ", str(player.get("nickname") or "")).strip() or "未知名稱"
+                profile["kingdom"] = str(player["kid"]) if player.get("kid") is not None else None
+
+            for code in codes:
+                results[code] = await _exchange_code_http(session, player_id, code, log_entry, debug_logs)
+            return results
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # 連線 / 逾時 / 非 JSON 回應視為暫時性錯誤，交給 run_redeem_with_retry 退避重試
+        logger.warning(f"[{player_id}] HTTP 兌換連線錯誤：{e!r}")
+        failure = {
+            "player_id": player_id,
+            "success": False,
+            "reason": f"_try http error: {e!r}",
+            "debug_logs": debug_logs
+        }
+        return {code: results.get(code) or dict(failure) for code in codes}
+
+async def _exchange_code_http(session, player_id, code, log_entry, debug_logs):
+    """已登入的 session：取驗證碼 → 2Captcha → 兌換，最多 OCR_MAX_RETRIES 次"""
+    for attempt in range(1, OCR_MAX_RETRIES + 1):
+        captcha = await giftcode_api_call(session, "captcha", {"fid": player_id, "init": 0})
+        img = ((captcha.get("data") or {}).get("img") or "").split(",")[-1]
+        if not img:
+            message = giftcode_api_message(captcha, "captcha")
+            log_entry(attempt, code=code, error=f"取得驗證碼失敗：{message}")
+            if any(k in message for k in THROTTLE_KEYWORDS):
+                RATE_CONTROLLER.on_throttle("captcha")
+            await asyncio.sleep(1 + attempt)
+            continue
 
-                    # 確認真的進到兌換頁
-                    await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-                    await page.wait_for_selector(".name", timeout=5000)
+        captcha_text, method_used = await CAPTCHA_BACKENDS.solve(base64.b64decode(img), player_id=player_id)
+        if not is_valid_captcha_text(captcha_text):
+            log_entry(attempt, code=code, error=f"驗證碼辨識不可用（{method_used}）：{captcha_text or 'None'}")
+            continue
+        log_entry(attempt, code=code, captcha_text=captcha_text, method=method_used)
 
-                    # 角色名稱
-                    name_el = await page.query_selector(".name")
-                    raw_name = await name_el.inner_text() if name_el else "未知名稱"
-                    name = re.sub(r"\s+", " ", raw_name).strip()
+        reply = await giftcode_api_call(session, "gift_code", {
+            "fid": player_id,
+            "cdk": code,
+            "captcha_code": captcha_text,
+        })
+        message = giftcode_api_message(reply, "gift_code")
+        log_entry(attempt, code=code, server_message=message, err_code=reply.get("err_code"))
+        logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{message}")
+        CAPTCHA_BACKENDS.feedback(method_used, message)
 
-                    # 王國
-                    kingdom = None
-                    try:
-                        for el in await page.query_selector_all(".other"):
-                            text = await el.inner_text()
-                            m = re.search(r"王國[:：]\s*(\d+)", text)
-                            if m:
-                                kingdom = m.group(1)
-                                break
-                    except Exception as e:
-                        logger.warning(f"[{pid}][Warn] 擷取王國失敗：{e}")
+        if giftcode_api_key(reply, "gift_code") in GIFTCODE_CAPTCHA_RETRY:
+            continue
+        if reply.get("err_code") == 20000:
+            return await _package_result(None, True, message, player_id, debug_logs)
+        return await _package_result(None, False, message, player_id, debug_logs)
 
-                    break  # 成功就跳出重試迴圈
+    log_entry(attempt, code=code, info="驗證碼三次辨識皆失敗，放棄兌換")
+    return await _package_result(None, False, "驗證碼三次辨識皆失敗，放棄兌換", player_id, debug_logs)
 
-                except Exception as e:
-                    logger.warning(f"[{pid}] fetch_name 第 {attempt+1} 次失敗：{e}")
-                    await page.wait_for_timeout(1000 * (attempt + 1))
+# === 共用函式：透過 Playwright 取得玩家名稱與王國 ===
+async def _scrape_profile(page):
+    """從已登入的兌換頁讀出（名稱, 王國）；王國讀不到時為 None"""
+    name_el = await page.query_selector(".name")
+    raw_name = await name_el.inner_text() if name_el else "未知名稱"
+    name = re.sub(r"\s+", " ", raw_name).strip()
 
-            return name, kingdom
-        finally:
-            await browser.close()
-            logger.info(f"[{pid}] Playwright 已關閉")
+    kingdom = None
+    try:
+        for el in await page.query_selector_all(".other"):
+            text = await el.inner_text()
+            m = re.search(r"王國[:：]\s*(\d+)", text)
+            if m:
+                kingdom = m.group(1)
+                break
+    except Exception as e:
+        logger.warning(f"[Warn] 擷取王國失敗：{e}")
+    return name, kingdom
 
-async def fetch_and_store_if_missing(guild_id, player_id, fetch_semaphore):
+@on_browser_loop
+async def fetch_name_and_kingdom_common(pid):
+    logger.info(f"[{pid}] Playwright 啟動準備")
+    context, page = await PAGE_POOL.acquire()
     try:
-        logger.info(f"[{player_id}] fetch_and_store_if_missing 呼叫進入")
+        name, kingdom = "未知名稱", None
 
-        async with fetch_semaphore:
-            ref = db.collection("ids").document(guild_id).collection("players").document(player_id)
-            doc = await firestore_get(ref)
-            if doc.exists:
-                logger.info(f"[{player_id}] fetch_and_store_if_missing 完成寫入或已存在 (已存在)")
-                return
+        for attempt in range(3):
+            try:
+                # 第一次直接使用預熱頁面，重試時才重新載入
+                if attempt > 0:
+                    await page.goto(GIFTCODE_URL, timeout=PAGE_LOAD_TIMEOUT)
 
-            name, kingdom = await fetch_name_and_kingdom_common(player_id)
+                # 角色ID欄位：中文優先、英文備援
+                try:
+                    await page.wait_for_selector('input[placeholder="角色ID"]:visible', timeout=5000)
+                    await page.fill('input[placeholder="角色ID"]', pid)
+                except Exception:
+                    await page.wait_for_selector('input[placeholder="Character ID"]:visible', timeout=5000)
+                    await page.fill('input[placeholder="Character ID"]', pid)
 
-            if is_valid_player_data(name, kingdom):
-                await firestore_set(ref, {
-                    "name": name,
-                    "kingdom": kingdom,
-                    "updated_at": datetime.now(timezone.utc)
-                }, merge=True)
-                logger.info(f"[{player_id}] fetch_and_store_if_missing 完成寫入或已存在 (新寫入)")
-            else:
-                logger.warning(f"[{player_id}] [Warn]名稱或王國未知，未寫入")
+                await page.click(".login_btn")
+
+                # 確認真的進到兌換頁
+                await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
+                await page.wait_for_selector(".name", timeout=5000)
+
+                name, kingdom = await _scrape_profile(page)
+
+                break  # 成功就跳出重試迴圈
+
+            except Exception as e:
+                logger.warning(f"[{pid}] fetch_name 第 {attempt+1} 次失敗：{e}")
+                await page.wait_for_timeout(1000 * (attempt + 1))
+
+        return name, kingdom
+    finally:
+        await PAGE_POOL.release(context)
+
+async def store_player_profile(guild_id, player_id, name, kingdom, existing=None, writer=None):
+    """兌換流程帶回的名稱 / 王國：缺少或有變更才寫入 ids/{guild}/players，有寫入回傳 True。
+    existing 為呼叫端已讀到的文件內容（{} 代表不存在），給了就不再讀一次；
+    給了 writer 則併入該批次寫入。"""
+    try:
+        if not is_valid_player_data(name, kingdom):
+            logger.warning(f"[{player_id}] [Warn]名稱或王國未知，未寫入")
+            return False
+        ref = db.collection("ids").document(guild_id).collection("players").document(player_id)
+        if existing is None:
+            doc = await firestore_get(ref)
+            existing = doc.to_dict() if doc.exists else {}
+        if existing.get("name") == name and existing.get("kingdom") == kingdom:
+            return False
+        data = {
+            "name": name,
+            "kingdom": kingdom,
+            "updated_at": datetime.now(timezone.utc)
+        }
+        if writer is not None:
+            writer.set(ref, data, merge=True, label=player_id)
+        else:
+            await firestore_set(ref, data, merge=True)
+        logger.info(f"[{player_id}] store_player_profile 已寫入（{'更新' if existing else '新增'}）")
+        return True
     except Exception as e:
-        logger.warning(f"[{player_id}] 抓取或更新失敗：{e}\n{traceback.format_exc()}")
+        logger.warning(f"[{player_id}] 名稱或王國寫入失敗：{e}")
+        return False
 
 def is_valid_player_data(name: str, kingdom: str) -> bool:
     return bool(name and kingdom) and name != "未知名稱" and kingdom != "未知" and str(kingdom).isdigit()
 
-async def format_failures_block(guild_id, all_fail):
+ROSTER_GET_ALL_CHUNK = 300
+ROSTER_CACHE_MAX_GUILDS = int(os.getenv("ROSTER_CACHE_MAX_GUILDS", "50"))  # 0 = 停用快取
+ROSTER_CACHE_READY_TIMEOUT = float(os.getenv("ROSTER_CACHE_READY_TIMEOUT", "15"))  # 秒，等待首次快照
+
+class RosterCache:
+    """ids/{guild}/players 常駐記憶體，由 on_snapshot 監聽保持最新；guild 數量以 LRU 限制"""
+
+    def __init__(self, max_guilds=ROSTER_CACHE_MAX_GUILDS):
+        self.max_guilds = max_guilds
+        self._guilds = collections.OrderedDict()  # guild_id -> {"players", "ready", "watch"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _on_snapshot(self, entry, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    entry["players"].pop(change.document.id, None)
+                else:
+                    entry["players"][change.document.id] = change.document.to_dict() or {}
+        entry["ready"].set()
+
+    def _watch(self, guild_id):
+        entry = {"players": {}, "ready": threading.Event(), "watch": None}
+        ref = db.collection("ids").document(guild_id).collection("players")
+        entry["watch"] = ref.on_snapshot(functools.partial(self._on_snapshot, entry))
+        return entry
+
+    def _unwatch(self, entry):
+        with contextlib.suppress(Exception):
+            entry["watch"].unsubscribe()
+
+    def get(self, guild_id):
+        """回傳 {player_id: data} 的淺拷貝（阻塞至首次快照完成）"""
+        with self._lock:
+            entry = self._guilds.get(guild_id)
+            # listener 因錯誤停止時資料不再更新，視同未命中重新監聽
+            if entry and not getattr(entry["watch"], "is_active", True):
+                self._guilds.pop(guild_id)
+                self._unwatch(entry)
+                entry = None
+            if entry:
+                self._guilds.move_to_end(guild_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            created = self._watch(guild_id)
+            with self._lock:
+                # 同一 guild 可能同時有兩個未命中（例如 /list_ids 與背景任務）：先放進去的勝出
+                entry = self._guilds.get(guild_id)
+                if entry is None or not getattr(entry["watch"], "is_active", True):
+                    entry, created = created, None
+                    self._guilds[guild_id] = entry
+                    while len(self._guilds) > self.max_guilds:
+                        _, evicted = self._guilds.popitem(last=False)
+                        self._unwatch(evicted)
+                        self.evictions += 1
+                else:
+                    self._guilds.move_to_end(guild_id)
+            if created is not None:
+                self._unwatch(created)
+        if not entry["ready"].wait(ROSTER_CACHE_READY_TIMEOUT):
+            raise TimeoutError(f"roster snapshot for {guild_id} not ready")
+        with self._lock:
+            return dict(entry["players"])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "guilds": len(self._guilds),
+                "max_guilds": self.max_guilds,
+                "players": sum(len(e["players"]) for e in self._guilds.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+ROSTER_CACHE = RosterCache()
+
+async def get_roster(guild_id):
+    """整個 guild 的名冊 {player_id: data}；快取停用或失敗時直接讀 Firestore"""
+    if ROSTER_CACHE.max_guilds > 0:
+        try:
+            return await run_in_executor(functools.partial(ROSTER_CACHE.get, guild_id))
+        except Exception as e:
+            logger.warning(f"[RosterCache] 讀取快取失敗，改直接讀 Firestore：{e}")
+    docs = await firestore_stream(db.collection("ids").document(guild_id).collection("players"))
+    return {doc.id: doc.to_dict() or {} for doc in docs}
+
+async def load_roster(guild_id, player_ids):
+    """取 ids/{guild}/players 中指定玩家，回傳 {player_id: data}；不存在的 ID 不列入。
+    有快取時直接從記憶體取，否則以 get_all 多筆讀取。"""
+    if ROSTER_CACHE.max_guilds > 0:
+        roster = await get_roster(guild_id)
+        return {pid: roster[pid] for pid in player_ids if pid in roster}
+
+    players = db.collection("ids").document(guild_id).collection("players")
+    refs = [players.document(pid) for pid in dict.fromkeys(player_ids)]
+
+    def fetch():
+        roster = {}
+        for i in range(0, len(refs), ROSTER_GET_ALL_CHUNK):
+            for snap in db.get_all(refs[i:i + ROSTER_GET_ALL_CHUNK]):
+                if snap.exists:
+                    roster[snap.id] = snap.to_dict() or {}
+        return roster
+
+    return await run_in_executor(fetch)
+
+# === 跨公會兌換紀錄：同一玩家常登記在多個公會，成功一次即可 ===
+# redeem_ledger/{code}_{shard}.player_ids：依玩家 ID 雜湊分成固定幾份，任務開始只讀這幾份文件
+REDEEM_LEDGER_SHARDS = 8  # 已寫入的資料依此分片，上線後不可更改
+
+def redeem_ledger_ref(code, shard):
+    return db.collection("redeem_ledger").document(f"{code}_{shard}")
+
+def redeem_ledger_shard(player_id):
+    return int(hashlib.md5(player_id.encode("utf-8")).hexdigest(), 16) % REDEEM_LEDGER_SHARDS
+
+async def load_redeem_ledger(code, player_ids):
+    """回傳 player_ids 中已在任一公會兌換成功 code 的玩家"""
+    wanted = set(player_ids)
+    if not wanted:
+        return set()
+    refs = [redeem_ledger_ref(code, shard) for shard in range(REDEEM_LEDGER_SHARDS)]
+
+    def fetch():
+        redeemed = set()
+        for snap in db.get_all(refs):
+            if snap.exists:
+                redeemed.update((snap.to_dict() or {}).get("player_ids", []))
+        return redeemed & wanted
+
+    return await run_in_executor(fetch)
+
+def stage_redeem_ledger(writer, code, player_ids):
+    """把本批真正兌換到的玩家併入對應分片（ArrayUnion，多個公會同時寫入也不會互相覆蓋）"""
+    by_shard = collections.defaultdict(list)
+    for pid in player_ids:
+        by_shard[redeem_ledger_shard(pid)].append(pid)
+    for shard, pids in by_shard.items():
+        writer.set(
+            redeem_ledger_ref(code, shard),
+            {"player_ids": firestore.ArrayUnion(sorted(pids)), "updated_at": datetime.now(timezone.utc)},
+            merge=True,
+            label=f"ledger:{code}_{shard}"
+        )
+
+async def format_failures_block(guild_id, all_fail, roster=None):
+    if roster is None:
+        roster = await load_roster(guild_id, [r["player_id"] for r in all_fail])
     lines = []
     for r in all_fail:
         pid = r["player_id"]
-        doc = await firestore_get(
-            db.collection("ids").document(guild_id).collection("players").document(pid)
-        )
-        data = doc.to_dict() if doc.exists else {}
+        data = roster.get(pid, {})
         name = data.get("name", "未知名稱")
         kingdom = data.get("kingdom", "未知")
         lines.append(f"- {pid}｜{kingdom}｜{name}")
     return "\n".join(lines)
 
+# === 持久化任務佇列（租約制）===
+# firestore（預設）：部署用，多個 web instance 共用且重啟不遺失
+# sqlite：單機 / 本機測試；容器內的檔案在重啟後就不見，部署時不要用
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "firestore")
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "redeem_jobs.sqlite3")
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS = max(1, JOB_LEASE_SECONDS // 3)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+JOB_LEASE_SCAN = 50  # Firestore 佇列每次取回多少筆候選再於本地排序
+
+class SqliteJobQueue:
+    """以 SQLite 保存任務；BEGIN IMMEDIATE 保證同一份檔案的多行程 / 多 thread 只會有一人取得租約"""
+
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS redeem_jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS redeem_jobs_status ON redeem_jobs (status, created_at)")
+
+    @contextlib.contextmanager
+    def _tx(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT INTO redeem_jobs (id, kind, payload, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        return job_id
+
+    def lease(self, worker_id):
+        now = time.time()
+        with self._tx() as conn:
+            # 租約過期太多次的任務不再重排
+            conn.execute(
+                "UPDATE redeem_jobs SET status='failed', error='lease expired too many times', updated_at=? "
+                "WHERE status='running' AND lease_expires < ? AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS)
+            )
+            row = conn.execute(
+                "SELECT * FROM redeem_jobs WHERE status='queued' OR (status='running' AND lease_expires < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE redeem_jobs SET status='running', lease_owner=?, lease_expires=?, attempts=attempts+1, updated_at=? WHERE id=?",
+                (worker_id, now + JOB_LEASE_SECONDS, now, row["id"])
+            )
+        return {"id": row["id"], "kind": row["kind"], "payload": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+    def heartbeat(self, job_id, worker_id):
+        now = time.time()
+        with self._tx() as conn:
+            cur = conn.execute(
+                "UPDATE redeem_jobs SET lease_expires=?, updated_at=? WHERE id=? AND status='running' AND lease_owner=?",
+                (now + JOB_LEASE_SECONDS, now, job_id, worker_id)
+            )
+        return cur.rowcount == 1
+
+    def complete(self, job_id, worker_id, error=None):
+        with self._tx() as conn:
+            cur = conn.execute(
+                "UPDATE redeem_jobs SET status=?, error=?, lease_owner=NULL, lease_expires=NULL, updated_at=? "
+                "WHERE id=? AND lease_owner=?",
+                ("failed" if error else "done", error, time.time(), job_id, worker_id)
+            )
+            return cur.rowcount > 0
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM redeem_jobs WHERE id=?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+class FirestoreJobQueue:
+    """redeem_jobs collection；租約以 transaction 取得，多個 instance 可共用"""
+
+    def __init__(self, collection="redeem_jobs"):
+        self.col = db.collection(collection)
+
+    def enqueue(self, kind, payload):
+        ref = self.col.document()
+        now = time.time()
+        ref.set({
+            "kind": kind,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "lease_owner": None,
+            "lease_expires": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        })
+        return ref.id
+
+    def lease(self, worker_id):
+        now = time.time()
+        # 只用單欄位等值查詢（不需建立複合索引），排序與租約過期在本地判斷
+        queued = list(self.col.where("status", "==", "queued").limit(JOB_LEASE_SCAN).stream())
+        queued.sort(key=lambda snap: (snap.to_dict() or {}).get("created_at") or 0)
+        running = [
+            snap for snap in self.col.where("status", "==", "running").limit(JOB_LEASE_SCAN).stream()
+            if ((snap.to_dict() or {}).get("lease_expires") or 0) < now
+        ]
+        candidates = queued[:5] + running[:5]
+
+        @firestore.transactional
+        def claim(transaction, ref):
+            snap = ref.get(transaction=transaction)
+            data = snap.to_dict() or {}
+            expired = data.get("status") == "running" and (data.get("lease_expires") or 0) < now
+            if data.get("status") != "queued" and not expired:
+                return None
+            if expired and data.get("attempts", 0) >= JOB_MAX_ATTEMPTS:
+                transaction.update(ref, {"status": "failed", "error": "lease expired too many times", "updated_at": now})
+                return None
+            attempts = data.get("attempts", 0) + 1
+            transaction.update(ref, {
+                "status": "running",
+                "lease_owner": worker_id,
+                "lease_expires": now + JOB_LEASE_SECONDS,
+                "attempts": attempts,
+                "updated_at": now,
+            })
+            return {"id": ref.id, "kind": data["kind"], "payload": data["payload"], "attempts": attempts}
+
+        for snap in candidates:
+            try:
+                job = claim(db.transaction(), snap.reference)
+            except Exception as e:
+                logger.warning(f"[JobQueue] 取得租約失敗 {snap.id}：{e}")
+                continue
+            if job:
+                return job
+        return None
+
+    def heartbeat(self, job_id, worker_id):
+        ref = self.col.document(job_id)
+
+        @firestore.transactional
+        def extend(transaction):
+            data = ref.get(transaction=transaction).to_dict() or {}
+            if data.get("status") != "running" or data.get("lease_owner") != worker_id:
+                return False
+            transaction.update(ref, {"lease_expires": time.time() + JOB_LEASE_SECONDS, "updated_at": time.time()})
+            return True
+
+        return extend(db.transaction())
+
+    def complete(self, job_id, worker_id, error=None):
+        ref = self.col.document(job_id)
+
+        @firestore.transactional
+        def finish(transaction):
+            # 租約過期後已被其他 worker 接手時不覆寫對方的狀態
+            data = ref.get(transaction=transaction).to_dict() or {}
+            if data.get("lease_owner") != worker_id:
+                return False
+            transaction.update(ref, {
+                "status": "failed" if error else "done",
+                "error": error,
+                "lease_owner": None,
+                "lease_expires": None,
+                "updated_at": time.time(),
+            })
+            return True
+
+        return finish(db.transaction())
+
+    def get(self, job_id):
+        snap = self.col.document(job_id).get()
+        return {"id": snap.id, **snap.to_dict()} if snap.exists else None
+
+JOB_QUEUE = FirestoreJobQueue() if JOB_QUEUE_BACKEND == "firestore" else SqliteJobQueue()
+
+class JobWorker(threading.Thread):
+    """輪詢佇列取得租約執行任務；執行期間另開 thread 定期續約，行程掛掉時租約過期由其他 worker 接手"""
+
+    def __init__(self, queue, index):
+        super().__init__(name=f"job-worker-{index}", daemon=True)
+        self.queue = queue
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+    def _heartbeat(self, job_id, done):
+        while not done.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                if not self.queue.heartbeat(job_id, self.worker_id):
+                    logger.warning(f"[JobQueue] 任務 {job_id} 租約已被取走，本 worker 將繼續完成但不再續約")
+                    return
+            except Exception as e:
+                logger.warning(f"[JobQueue] 任務 {job_id} 續約失敗：{e}")
+
+    def run(self):
+        while True:
+            try:
+                job = self.queue.lease(self.worker_id)
+            except Exception as e:
+                logger.warning(f"[JobQueue] lease 失敗：{e}")
+                job = None
+            if not job:
+                time.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            logger.info(f"[JobQueue] {self.worker_id} 取得任務 {job['id']} kind={job['kind']} attempts={job['attempts']}")
+            done = threading.Event()
+            threading.Thread(target=self._heartbeat, args=(job["id"], done), daemon=True).start()
+            error = None
+            try:
+                log_and_run(JOB_HANDLERS[job["kind"]](job["payload"]))
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                logger.error(f"[JobQueue] 任務 {job['id']} 執行失敗\n{traceback.format_exc()}")
+            finally:
+                done.set()
+            try:
+                if not self.queue.complete(job["id"], self.worker_id, error=error):
+                    logger.warning(f"[JobQueue] 任務 {job['id']} 租約已屬於其他 worker，不寫入完成狀態")
+            except Exception as e:
+                logger.warning(f"[JobQueue] 任務 {job['id']} 完成狀態寫入失敗：{e}")
+
+def start_job_workers(count=REDEEM_JOB_WORKERS):
+    for i in range(count):
+        JobWorker(JOB_QUEUE, i).start()
+    logger.info(f"[JobQueue] backend={JOB_QUEUE_BACKEND} 啟動 {count} 個 worker")
+
 # === Flask API ===
 @app.route("/favicon.ico")
 def favicon():
@@ -1037,23 +3032,42 @@ def list_ids():
 
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        docs = loop.run_until_complete(
-            firestore_stream(db.collection("ids").document(guild_id).collection("players"))
-        )
-        players = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+        roster = loop.run_until_complete(get_roster(guild_id))
+        players = [{"id": pid, **data} for pid, data in roster.items()]
         return jsonify({"success": True, "players": players})
     except Exception as e:
         return jsonify({"success": False, "reason": str(e)}), 500
 
+def known_dead_code_reply(code):
+    """全部兌換碼都已知失效時回傳可直接回覆的 response；部分失效時照常排入，由任務回報快取結果"""
+    codes = [code] if isinstance(code, str) else list(code)
+    code_entries = [CODE_REGISTRY.get(c) for c in codes]
+    if not all(CODE_REGISTRY.is_dead(e) for e in code_entries):
+        return None
+    reasons = [
+        f"兌換碼 {c} {CODE_STATUS_LABELS[e['status']]}：{e.get('message') or e['status']} / Gift code {e['status']}"
+        for c, e in zip(codes, code_entries)
+    ]
+    logger.info(f"[API] 兌換碼 {codes} 已知失效，不排入任務")
+    return jsonify({
+        "success": False,
+        "reason": "\n".join(reasons),
+        "code_status": code_entries[0]["status"],
+        "job_id": None
+    }), 200
+
 @app.route("/redeem_submit", methods=["POST"])
 def redeem_submit():
     data = request.get_json() or {}
     payload = {
-        "code": data.get("code"),
+        "code": data.get("codes") or data.get("code"),  # 單一兌換碼或清單；清單時每位玩家只登入一次
         "player_ids": data.get("player_ids") or [],
         "guild_id": data.get("guild_id"),
         "debug": bool(data.get("debug", False)),
-        "retry": False
+        "retry": False,
+        "concurrency": data.get("concurrency"),
+        "engine": data.get("engine"),
+        "processes": data.get("processes")
     }
 
     # 參數檢查
@@ -1061,17 +3075,12 @@ def redeem_submit():
         return jsonify({"success": False, "reason": "缺少必要參數"}), 400
 
     logger.info(f"[API] /redeem_submit 收到請求：guild={payload['guild_id']} code={payload['code']} players={len(payload['player_ids'])}")
-    logger.info(f"[ThreadPool] 提交 redeem 任務")
-
-    REDEEM_THREAD_POOL.submit(lambda: log_and_run(
-        process_redeem(
-            payload["code"],
-            payload["player_ids"],
-            payload["guild_id"],
-            retry=False
-        )
-    ))
-    return jsonify({"message": "兌換任務已提交，背景處理中"}), 200
+    dead_reply = known_dead_code_reply(payload["code"])
+    if dead_reply:
+        return dead_reply
+    job_id = JOB_QUEUE.enqueue("redeem", payload)
+    logger.info(f"[JobQueue] 已排入 redeem 任務 job_id={job_id}")
+    return jsonify({"message": "兌換任務已提交，背景處理中", "job_id": job_id}), 200
 
 # redeem_web.py
 @app.route("/retry_failed", methods=["POST"])
@@ -1080,18 +3089,57 @@ def retry_failed():
         payload = request.get_json() or {}
         payload["retry"] = True  # 確保一定為重試
         logger.info(f"[retry_failed] 接收到 retry 請求：{payload}")
-        threading.Thread(target=thread_runner, args=(payload,), daemon=True).start()
-        return jsonify({"success": True, "message": "Retry request submitted"})
+        if not payload.get("guild_id") or not payload.get("code") or not payload.get("player_ids"):
+            return jsonify({"success": False, "reason": "缺少必要參數"}), 400
+        job_id = JOB_QUEUE.enqueue("retry", payload)
+        return jsonify({"success": True, "message": "Retry request submitted", "job_id": job_id})
     except Exception as e:
         logger.exception("[retry_failed] 發生例外")
         return jsonify({"success": False, "error": str(e)}), 500
 
-def thread_runner(payload):
-    try:
-        # 直接走 retry
-        asyncio.run(process_retry(payload))
-    except Exception as e:
-        logger.error(f"[thread_runner] 執行 retry 發生錯誤\n{traceback.format_exc()}")
+@app.route("/broadcast_submit", methods=["POST"])
+def broadcast_submit():
+    """同一組兌換碼一次兌換多個公會（未給 guild_ids 則為全部公會），重複登記的玩家只兌換一次"""
+    data = request.get_json() or {}
+    payload = {
+        "code": data.get("codes") or data.get("code"),
+        "guild_ids": data.get("guild_ids") or [],  # 空清單 = 全部公會
+        "concurrency": data.get("concurrency"),
+        "engine": data.get("engine"),
+        "processes": data.get("processes")
+    }
+    if not payload["code"]:
+        return jsonify({"success": False, "reason": "缺少必要參數"}), 400
+
+    logger.info(f"[API] /broadcast_submit 收到請求：code={payload['code']} guilds={payload['guild_ids'] or 'ALL'}")
+    dead_reply = known_dead_code_reply(payload["code"])
+    if dead_reply:
+        return dead_reply
+    job_id = JOB_QUEUE.enqueue("broadcast", payload)
+    logger.info(f"[JobQueue] 已排入 broadcast 任務 job_id={job_id}")
+    return jsonify({"message": "廣播兌換任務已提交，背景處理中", "job_id": job_id}), 200
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = JOB_QUEUE.get(job_id)
+    if not job:
+        return jsonify({"success": False, "reason": "找不到任務 / Job not found"}), 404
+    payload = job.pop("payload", {}) or {}
+    job["guild_id"] = payload.get("guild_id")
+    job["code"] = payload.get("code")
+    job["player_count"] = len(payload.get("player_ids") or [])
+    if "guild_ids" in payload:
+        job["guild_ids"] = payload["guild_ids"] or "ALL"
+    return jsonify({"success": True, "job": job})
+
+async def process_redeem_job(payload: dict):
+    logger.info(f"[process_redeem_job] 開始處理，guild_id={payload['guild_id']} code={payload['code']} 人數={len(payload['player_ids'])}")
+    await process_redeem(
+        payload["code"], payload["player_ids"], payload["guild_id"], retry=False,
+        concurrency=payload.get("concurrency"),
+        engine=payload.get("engine"),
+        processes=payload.get("processes")
+    )
 
 async def process_retry(payload: dict):
     code = payload["code"]
@@ -1099,7 +3147,47 @@ async def process_retry(payload: dict):
     guild_id = payload["guild_id"]
     debug = payload.get("debug", False)
     logger.info(f"[process_retry] 開始處理 retry，guild_id={guild_id} code={code} 人數={len(player_ids)}")
-    await process_redeem(code, player_ids, guild_id, retry=True)
+    await process_redeem(
+        code, player_ids, guild_id, retry=True,
+        concurrency=payload.get("concurrency"),
+        engine=payload.get("engine"),
+        processes=payload.get("processes")
+    )
+
+async def list_guild_ids():
+    """ids/ 底下所有公會；公會文件本身可能不存在（只有 players 子集合），因此用 list_documents"""
+    refs = await run_in_executor(lambda: list(db.collection("ids").list_documents()))
+    return [ref.id for ref in refs]
+
+async def process_broadcast_job(payload: dict):
+    code = payload["code"]
+    codes = [code] if isinstance(code, str) else list(dict.fromkeys(code))
+    guild_ids = payload.get("guild_ids") or await list_guild_ids()
+    logger.info(f"[process_broadcast_job] 開始處理，codes={codes} 公會數={len(guild_ids)}")
+
+    runs = []
+    unique_players = set()
+    for guild_id in guild_ids:
+        roster = await get_roster(guild_id)
+        if not roster:
+            continue
+        unique_players.update(roster)
+        runs.extend(RedeemRun(guild_id, c, list(roster)) for c in codes)
+    registrations = sum(len(run.player_ids) for run in runs) // max(1, len(codes))
+    logger.info(f"[process_broadcast_job] 登記 {registrations} 筆，不重複玩家 {len(unique_players)} 位")
+    if runs:
+        await redeem_runs(
+            runs,
+            concurrency=payload.get("concurrency"),
+            engine=payload.get("engine"),
+            processes=payload.get("processes")
+        )
+
+JOB_HANDLERS = {
+    "redeem": process_redeem_job,
+    "retry": process_retry,
+    "broadcast": process_broadcast_job,
+}
 
 @app.route("/update_names_api", methods=["POST"])
 def update_names_api():
@@ -1116,29 +3204,29 @@ def update_names_api():
         try:
             # 讀 IDs
             try:
-                player_docs = loop.run_until_complete(
-                    firestore_stream(db.collection("ids").document(guild_id).collection("players"))
-                )
+                roster = loop.run_until_complete(get_roster(guild_id))
             except Exception as e:
                 logger.error(f"[Firestore] 讀取 IDs 出錯：{e}")
                 return jsonify({"success": False, "reason": str(e)}), 500
 
-            player_ids = [doc.id for doc in player_docs]
+            player_ids = list(roster)
 
-            async def fetch_all():
-                for pid in player_ids:
+            # 查名是獨立登入，依 REDEEM_FETCH_CONCURRENCY（或 payload fetch_concurrency）平行處理
+            fetch_semaphore = asyncio.Semaphore(clamp_concurrency(data.get("fetch_concurrency"), DEFAULT_FETCH_LIMIT))
+
+            async def fetch_one(pid):
+                async with fetch_semaphore:
                     try:
                         name, kingdom = await fetch_name_and_kingdom_common(pid)
 
                         doc_ref = db.collection("ids").document(guild_id).collection("players").document(pid)
-                        existing_doc = await firestore_get(doc_ref)
-                        doc_data = existing_doc.to_dict() if existing_doc.exists else {}
+                        doc_data = roster.get(pid) or {}
                         existing_name = doc_data.get("name")
                         existing_kingdom = doc_data.get("kingdom")
 
                         if name == "未知名稱" or not kingdom or kingdom == "未知":
                             logger.warning(f"[{pid}] 名稱或王國為未知，跳過更新")
-                            continue
+                            return
 
                         if existing_name != name or existing_kingdom != kingdom:
                             updated.append({
@@ -1158,6 +3246,9 @@ def update_names_api():
                     except Exception as e:
                         logger.error(f"[{pid}] 抓取或更新失敗：{e}")
 
+            async def fetch_all():
+                await asyncio.gather(*(fetch_one(pid) for pid in player_ids))
+
             loop.run_until_complete(fetch_all())
 
         finally:
@@ -1244,6 +3335,22 @@ def send_to_discord(channel_id, mention, message):
 def health():
     return "Worker ready for redeeming!"
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify({
+        "browser": BROWSER_MANAGER.stats(),
+        "page_pool": PAGE_POOL.stats(),
+        "roster_cache": ROSTER_CACHE.stats(),
+        "rate_controller": RATE_CONTROLLER.stats(),
+        "code_registry": CODE_REGISTRY.stats(),
+        "captcha_solver": CAPTCHA_SOLVER.stats(),
+        "captcha_backends": CAPTCHA_BACKENDS.stats(),
+        "captcha_preprocess": CAPTCHA_PREPROCESSOR.stats(),
+        "captcha_capture": CAPTCHA_CAPTURE.stats(),
+        "browser_outcomes": dict(BROWSER_OUTCOME_SOURCES),
+        "resource_filter": RESOURCE_FILTER.stats(),
+    })
+
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")  # ← 你要把你的 Secret 存進環境變數
 
 async def get_translate_setting(group_id: str) -> bool:
@@ -1527,6 +3634,10 @@ def send_to_line_group(message):
     except Exception as e:
         logger.warning(f"[LINE] ❌ 推播發生例外：{e}")
 
+# spawn 出來的分片子行程也會 import 本模組，只有主行程才啟動任務 worker
+if multiprocessing.parent_process() is None:
+    start_job_workers()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     #threading.Thread(target=lambda: loop.run_until_complete(self_ping_loop()), daemon=True).start()
@@ -0,0 +1,70 @@
+# 測試共用設定：redeem_web 匯入前先設好環境變數，並以 giftcode_stub_server 取代禮包碼 API 與 2Captcha
+#
+# 執行：
+#   pip install -r requirements.txt pytest
+#   python -m pytest web/tests -q
+import asyncio
+import os
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+WEB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB_DIR)
+
+os.environ.update({
+    "REDEEM_ENGINE": "http",
+    "REDEEM_JOB_WORKERS": "0",            # 不在匯入時啟動任務 worker
+    "CAPTCHA_API_KEY": "stub",
+    "CAPTCHA_BACKENDS": "2captcha",       # 不依賴是否安裝 ddddocr
+    "CAPTCHA_PREPROCESS": "",
+    "CAPTCHA_FIRST_POLL_DELAY": "0.05",
+    "CAPTCHA_POLL_INTERVAL": "0.05",
+    "CAPTCHA_SOLVE_TIMEOUT": "10",
+})
+
+# 測試絕不連到真正的 Firestore：匯入時以 MagicMock 取代 client
+import firebase_admin  # noqa: E402
+from firebase_admin import credentials, firestore  # noqa: E402
+
+with mock.patch.object(firebase_admin, "initialize_app"), \
+        mock.patch.object(credentials, "Certificate"), \
+        mock.patch.object(firestore, "client", return_value=mock.MagicMock()):
+    import redeem_web  # noqa: E402
+
+from giftcode_stub_server import make_app  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """start(**make_app 參數) 在背景 thread 啟動 stub，並把 redeem_web 的 API 位址指過去"""
+    started = []
+
+    def start(valid_codes=("WOSSTUB",), expired_codes=("WOSOLD",), used_codes=("WOSUSED",), **options):
+        loop = asyncio.new_event_loop()
+        app = make_app(set(valid_codes), set(expired_codes), used_codes=set(used_codes), **options)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        port = runner.addresses[0][1]
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        started.append((loop, runner))
+
+        base = f"http://127.0.0.1:{port}"
+        monkeypatch.setattr(redeem_web, "WOS_API_BASE", f"{base}/api")
+        monkeypatch.setattr(redeem_web, "CAPTCHA_API_BASE", base)
+        return base
+
+    yield start
+
+    # 共用的 2Captcha session 綁在自己的背景迴圈上，也一併關閉，避免結束時的 Unclosed client session 警告
+    solver = redeem_web.CAPTCHA_SOLVER
+    if solver._session is not None and not solver._session.closed:
+        asyncio.run_coroutine_threadsafe(solver._session.close(), solver.runner.loop).result(timeout=5)
+    for loop, runner in started:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
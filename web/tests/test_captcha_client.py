@@ -0,0 +1,65 @@
+# TwoCaptchaClient：以 giftcode_stub_server 的 /in.php、/res.php 驗證批次輪詢
+import asyncio
+import base64
+
+import pytest
+
+import redeem_web
+
+
+@pytest.fixture
+def client():
+    solver = redeem_web.TwoCaptchaClient()
+    yield solver
+    if solver._session is not None:
+        asyncio.run_coroutine_threadsafe(solver._session.close(), solver.runner.loop).result(timeout=5)
+
+
+def fetch_captchas(count):
+    """向 stub 取 count 張驗證碼，回傳 [(圖片 base64, 答案)]"""
+    async def run():
+        images = []
+        try:
+            async with redeem_web.giftcode_session() as session:
+                for fid in range(count):
+                    reply = await redeem_web.giftcode_api_call(session, "captcha", {"fid": str(fid), "init": 0})
+                    img = reply["data"]["img"].split(",")[-1]
+                    images.append((img, base64.b64decode(img).split(b":")[1].decode()))
+        finally:
+            await redeem_web.close_http_connector()
+        return images
+    return asyncio.run(run())
+
+
+def solve_all(client, images):
+    async def run():
+        return await asyncio.gather(*(client.solve(img) for img in images))
+    return asyncio.run(run())
+
+
+def test_concurrent_solves_share_batched_polls(stub, client):
+    stub(solve_delay=0.3)
+    captchas = fetch_captchas(10)
+
+    answers = solve_all(client, [img for img, _ in captchas])
+
+    assert answers == [text for _, text in captchas]
+    stats = client.stats()
+    assert (stats["submitted"], stats["solved"], stats["waiting"]) == (10, 10, 0)
+    # 同一輪的未完成任務以 ids= 一次查完，輪詢次數與任務數無關
+    assert stats["polls"] < 10
+
+
+def test_rejected_submission_returns_none(stub, client):
+    stub()
+    assert solve_all(client, [base64.b64encode(b"not from the stub").decode()]) == [None]
+    assert client.stats()["errors"] == 1
+    assert client.stats()["submitted"] == 0
+
+
+def test_missing_api_key_skips_remote(stub, client, monkeypatch):
+    stub()
+    monkeypatch.delenv("CAPTCHA_API_KEY")
+    img, _ = fetch_captchas(1)[0]
+    assert solve_all(client, [img]) == [None]
+    assert client.stats()["submitted"] == 0
@@ -0,0 +1,98 @@
+# HTTP 兌換引擎：以 giftcode_stub_server 跑完整的 登入 → 驗證碼 → 兌換 流程
+import asyncio
+import random
+
+import redeem_web
+
+
+def redeem(player_id, codes):
+    async def run():
+        try:
+            return await redeem_web._redeem_once_http(player_id, codes, [], 0)
+        finally:
+            await redeem_web.close_http_connector()
+    return asyncio.run(run())
+
+
+def test_giftcode_api_key_depends_on_endpoint():
+    assert redeem_web.giftcode_api_key({"err_code": 40004}, "player") == "ROLE NOT EXIST"
+    assert redeem_web.giftcode_api_key({"err_code": 40004}, "gift_code") == "TIMEOUT RETRY"
+    assert redeem_web.giftcode_api_key({"err_code": "40005"}, "gift_code") == "USED"
+    # err_code 對不到時改比對 msg
+    assert redeem_web.giftcode_api_key({"msg": "time error.", "err_code": ""}, "gift_code") == "TIME ERROR"
+    assert redeem_web.giftcode_api_key({"msg": "???", "err_code": 99999}, "gift_code") is None
+
+
+def test_classify_code_failure():
+    assert redeem_web.classify_code_failure("超出兌換時間") == "expired"
+    assert redeem_web.classify_code_failure("兌換碼可兌換次數已達上限") == "expired"
+    assert redeem_web.classify_code_failure("兌換碼不存在") == "nonexistent"
+    # 玩家 / 驗證碼層級的失敗不能拿來判斷兌換碼
+    assert redeem_web.classify_code_failure("登入失敗：角色不存在") is None
+    assert redeem_web.classify_code_failure("驗證碼已過期") is None
+    assert redeem_web.classify_code_failure(None, "兌換成功，請在信件中領取獎勵！") is None
+
+
+def test_valid_code_then_received(stub):
+    stub()
+    first = redeem("12345", ["WOSSTUB"])["WOSSTUB"]
+    assert first["success"] is True
+    assert redeem_web.is_success_reason(first["reason"], first["message"])
+
+    again = redeem("12345", ["WOSSTUB"])["WOSSTUB"]
+    assert again["success"] is False
+    assert again["reason"] == "您已領取過該禮包"
+    assert redeem_web.is_success_reason(again["reason"], again["message"])
+    assert redeem_web.is_redeemed_reason(again["reason"], again["message"])
+    assert redeem_web.classify_code_failure(again["reason"]) is None
+
+
+def test_code_level_failures(stub):
+    stub()
+    results = redeem("12345", ["WOSOLD", "WOSUSED", "NOSUCHCODE"])
+
+    assert results["WOSOLD"]["reason"] == "超出兌換時間"
+    assert results["WOSUSED"]["reason"] == "兌換碼可兌換次數已達上限"
+    assert results["NOSUCHCODE"]["reason"] == "兌換碼不存在"
+    for result in results.values():
+        assert result["success"] is False
+        assert not redeem_web.is_redeemed_reason(result["reason"], result["message"])
+    # 「超出兌換時間」沿用原本的不再重試，兌換碼用完則不可當成已兌換
+    assert redeem_web.is_success_reason(results["WOSOLD"]["reason"])
+    assert not redeem_web.is_success_reason(results["WOSUSED"]["reason"])
+    assert not redeem_web.is_success_reason(results["NOSUCHCODE"]["reason"])
+    assert redeem_web.classify_code_failure(results["WOSOLD"]["reason"]) == "expired"
+    assert redeem_web.classify_code_failure(results["WOSUSED"]["reason"]) == "expired"
+    assert redeem_web.classify_code_failure(results["NOSUCHCODE"]["reason"]) == "nonexistent"
+
+
+def test_unknown_player(stub):
+    stub()
+    result = redeem("abc", ["WOSSTUB"])["WOSSTUB"]
+    assert result["success"] is False
+    assert result["reason"] == "登入失敗：角色不存在"
+    assert redeem_web.classify_code_failure(result["reason"]) is None
+
+
+def test_wrong_captcha_gives_up(stub):
+    random.seed(0)  # stub 以 random 產生驗證碼並決定是否答錯，固定種子避免反轉後恰好相同
+    stub(wrong_rate=1.0)
+    result = redeem("12345", ["WOSSTUB"])["WOSSTUB"]
+    assert result["success"] is False
+    assert result["reason"] == "驗證碼三次辨識皆失敗，放棄兌換"
+    assert redeem_web.is_captcha_failure(result["reason"])
+    errors = [log["server_message"] for log in result["debug_logs"] if "server_message" in log]
+    assert errors == ["驗證碼錯誤"] * redeem_web.OCR_MAX_RETRIES
+
+
+def test_throttle_reaches_rate_controller(stub, monkeypatch):
+    stub(throttle_rate=1.0)
+    monkeypatch.setattr(redeem_web, "OCR_MAX_RETRIES", 1)
+    controller = redeem_web.AdaptiveRateController(initial=4)
+    monkeypatch.setattr(redeem_web, "RATE_CONTROLLER", controller)
+
+    result = redeem("12345", ["WOSSTUB"])["WOSSTUB"]
+
+    assert result["success"] is False
+    assert controller.throttles["captcha"] == 1
+    assert controller.limit == 2
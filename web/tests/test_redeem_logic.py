@@ -0,0 +1,106 @@
+# 不需網路的純邏輯：AIMD 速率控制、SQLite 任務佇列租約、redeem_status 摘要的批次寫入
+import redeem_web
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.writes = []
+
+    def set(self, ref, data, merge=False, label=None):
+        self.writes.append((ref, data, merge))
+
+
+def test_rate_controller_aimd(monkeypatch):
+    controller = redeem_web.AdaptiveRateController(initial=4, maximum=8)
+
+    for _ in range(4):
+        controller.on_success()
+    assert controller.limit == 5
+    assert controller.increases == 1
+
+    controller.on_throttle("captcha")
+    assert controller.limit == 2.5
+    assert controller.interval > 0
+    # 同一波節流（冷卻時間內）只計數，不再降
+    controller.on_throttle("captcha")
+    assert controller.limit == 2.5
+    assert controller.throttles["captcha"] == 2
+
+    monkeypatch.setattr(redeem_web, "AIMD_COOLDOWN", 0)
+    for _ in range(5):
+        controller.on_throttle("message")
+    assert controller.limit == controller.minimum
+
+
+def test_rate_controller_share_and_resize():
+    controller = redeem_web.AdaptiveRateController(initial=8, maximum=16)
+    assert controller.share(4) == (2, 4)
+    assert controller.share(32) == (1, 1)
+
+    controller.resize(2, 4)
+    assert (controller.limit, controller.maximum) == (2, 4)
+    controller.resize(10, 4)
+    assert controller.limit == 4
+
+
+def test_sqlite_queue_leases_in_order(tmp_path):
+    jobs = redeem_web.SqliteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    first = jobs.enqueue("redeem", {"code": "A"})
+    second = jobs.enqueue("redeem", {"code": "B"})
+
+    leased = jobs.lease("w1")
+    assert (leased["id"], leased["payload"], leased["attempts"]) == (first, {"code": "A"}, 1)
+    assert jobs.lease("w2")["id"] == second
+    assert jobs.lease("w3") is None
+
+    assert jobs.heartbeat(first, "w1")
+    assert not jobs.heartbeat(first, "w2")
+    assert not jobs.complete(first, "w2")
+    assert jobs.complete(first, "w1")
+    assert jobs.get(first)["status"] == "done"
+    assert jobs.complete(second, "w2", error="boom")
+    assert jobs.get(second)["status"] == "failed"
+
+
+def test_sqlite_queue_expired_lease_is_taken_over(tmp_path, monkeypatch):
+    jobs = redeem_web.SqliteJobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id = jobs.enqueue("redeem", {})
+    monkeypatch.setattr(redeem_web, "JOB_LEASE_SECONDS", -1)  # 租約一取得就過期
+
+    assert jobs.lease("w1")["attempts"] == 1
+    takeover = jobs.lease("w2")
+    assert (takeover["id"], takeover["attempts"]) == (job_id, 2)
+    # 原本的 worker 已失去租約，不能再覆寫結果
+    assert not jobs.complete(job_id, "w1")
+
+    monkeypatch.setattr(redeem_web, "JOB_MAX_ATTEMPTS", 2)
+    assert jobs.lease("w3") is None
+    job = jobs.get(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "lease expired too many times"
+
+
+def test_redeem_status_stage_batches_changes():
+    status = redeem_web.RedeemStatus("guild", "CODE")
+    status.failed_ids = {"1"}
+    status.record_success("1")
+    status.record_failure("2", "驗證碼三次辨識皆失敗，放棄兌換")
+    status.record_failure("3", "超出兌換時間")
+
+    writer = RecordingWriter()
+    status.stage(writer)
+
+    (ref, added, merge), (_, removed, _) = writer.writes
+    assert ref is status.ref and merge
+    assert added["success_ids"].values == ["1"]
+    assert added["failed_ids"].values == ["2", "3"]
+    assert added["captcha_failed_ids"].values == ["2"]
+    assert "updated_at" in added
+    assert removed["failed_ids"].values == ["1"]
+    assert removed["captcha_failed_ids"].values == ["1", "3"]
+    assert status.failed_ids == {"2", "3"}
+
+    # 已寫出的異動不會重複寫
+    writer.writes.clear()
+    status.stage(writer)
+    assert writer.writes == []